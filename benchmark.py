@@ -0,0 +1,605 @@
+"""
+Offline benchmark for the importer.
+
+Runs a full sync against local stand-ins for Plaid and Firefly III, fed with a synthetic history,
+and reports the end-to-end time, the requests issued, the peak memory and the latency of each stage.
+Nothing leaves the machine, so runs can be compared to catch performance regressions.
+
+    python benchmark.py --transactions 100000 --page-size 500 --plaid-latency 50
+
+With --conversion it instead times only the conversion of Plaid transactions to Firefly III
+payloads, on both raw JSON dicts and Plaid model objects, which is what bounds CPU-heavy backfills.
+"""
+import argparse
+import datetime
+import importlib.util
+import json
+import multiprocessing
+import os
+import random
+import re
+import resource
+import statistics
+import tempfile
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+ACCOUNTS_PER_ITEM = 3
+FIRST_DATE = datetime.date(2020, 1, 1)
+MERCHANTS = ["Grocer", "Coffee Shop", "Gas Station", "Pharmacy", "Hardware Store", "Bookstore", "Restaurant"]
+
+
+def load_importer():
+    """
+    Loads import.py as a module. Its file name is a Python keyword, so it can't be imported by name.
+
+    Returns:
+        module: The importer module.
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'import.py')
+    spec = importlib.util.spec_from_file_location('importer', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_transaction(item, index, per_item):
+    """
+    Builds one Plaid transaction of the synthetic history, the same every time for the same index.
+    About one in fifty repeats the amount and name of the one before it, to exercise duplicate handling.
+
+    Args:
+        item (int): The number of the Plaid item.
+        index (int): The position of the transaction in the item's history.
+        per_item (int): The number of transactions in the item's history.
+
+    Returns:
+        dict: The transaction in the JSON format of /transactions/sync.
+    """
+    seed = index - 1 if index and index % 50 == 0 else index
+    rng = random.Random(item * 1_000_003 + seed)
+    merchant = rng.choice(MERCHANTS)
+    date = FIRST_DATE + datetime.timedelta(days=index * 730 // max(per_item, 1))
+
+    return {
+        "account_id": f"item{item}-account{rng.randrange(ACCOUNTS_PER_ITEM)}",
+        "account_owner": None,
+        "amount": round(rng.uniform(-500, 500), 2) or 1.0,
+        "authorized_date": date.isoformat(),
+        "authorized_datetime": None,
+        "category": ["Shops", merchant],
+        "category_id": "19000000",
+        "check_number": None,
+        "counterparties": [],
+        "date": date.isoformat(),
+        "datetime": None,
+        "iso_currency_code": "CAD",
+        "location": {
+            "address": f"{rng.randrange(1, 999)} Main St", "city": "Ottawa", "region": "ON",
+            "postal_code": "K1A 0A1", "country": "CA", "lat": None, "lon": None, "store_number": None
+        },
+        "logo_url": None,
+        "merchant_entity_id": None,
+        "merchant_name": merchant if rng.random() < 0.7 else None,
+        "name": f"{merchant.upper()} #{rng.randrange(100)}",
+        "payment_channel": "in store",
+        "payment_meta": {
+            "by_order_of": None, "payee": None, "payer": None, "payment_method": None,
+            "payment_processor": None, "ppd_id": None, "reason": None, "reference_number": None
+        },
+        "pending": False,
+        "pending_transaction_id": None,
+        "personal_finance_category": {
+            "primary": "GENERAL_MERCHANDISE", "detailed": "GENERAL_MERCHANDISE_OTHER", "confidence_level": "HIGH"
+        },
+        "personal_finance_category_icon_url": "https://plaid-category-icons.plaid.com/PFC_GENERAL_MERCHANDISE.png",
+        "transaction_code": None,
+        "transaction_id": f"item{item}-txn{index}",
+        "transaction_type": "place",
+        "unofficial_currency_code": None,
+        "website": None
+    }
+
+
+def expected_inserts(options):
+    """
+    Counts the Firefly III transactions the synthetic history should be inserted as: one for each
+    transaction that doesn't repeat the one before it in its account on the same day. The count
+    doesn't depend on how the history is paged, so a sync inserting a different number has
+    grouped duplicates differently at page boundaries.
+
+    Returns:
+        int: The number of inserts expected.
+    """
+    per_item = options['transactions'] // options['items']
+    inserts = 0
+    for item in range(options['items']):
+        last = {}
+        for index in range(per_item):
+            transaction = synthetic_transaction(item, index, per_item)
+            key = (transaction['amount'], transaction['name'], transaction['date'])
+            if last.get(transaction['account_id']) != key:
+                inserts += 1
+            last[transaction['account_id']] = key
+    return inserts
+
+
+def existing_transaction(index, accounts):
+    """
+    Builds one transaction of the ledger already in the stand-in Firefly III.
+    Every fifth one has no external ID, as if it was entered by hand.
+
+    Args:
+        index (int): The position of the transaction in the ledger.
+        accounts (int): The number of Firefly accounts in the ledger.
+
+    Returns:
+        dict: The transaction in the JSON format of the Firefly III API.
+    """
+    rng = random.Random(-index)
+    account = str(index % accounts + 1)
+    date = FIRST_DATE + datetime.timedelta(days=index % 730)
+    return {
+        "id": str(index + 1),
+        "attributes": {"transactions": [{
+            "transaction_journal_id": str(index + 1),
+            "external_id": None if index % 5 == 0 else f"existing-{index}",
+            "date": f"{date.isoformat()}T00:00:00+00:00",
+            "amount": f"{rng.uniform(1, 500):.12f}",
+            "type": "withdrawal",
+            "source_id": account,
+            "tags": []
+        }]}
+    }
+
+
+class Stats:
+    """
+    Thread-safe request counters of a stand-in server.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = {}
+
+    def count(self, name):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+
+def plaid_handler(options, stats):
+    """
+    Builds the request handler of the stand-in Plaid server. It speaks /transactions/sync,
+    where a cursor is the offset of the next page in the item's synthetic history, and the
+    /accounts/get and /transactions/get calls of a backfill.
+    """
+    per_item = options['transactions'] // options['items']
+    histories = {}
+
+    def history(item):
+        if item not in histories:
+            histories[item] = [synthetic_transaction(item, i, per_item) for i in range(per_item)]
+        return histories[item]
+
+    def item_details(item):
+        return {
+            "item_id": f"item{item}", "webhook": "", "error": None, "available_products": [],
+            "billed_products": ["transactions"], "consent_expiration_time": None, "update_type": "background"
+        }
+
+    class PlaidHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, body, status=200):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            self.send_json(stats.requests)
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            stats.count(self.path)
+            time.sleep(options['plaid_latency'] / 1000)
+
+            item = int(request['access_token'].rsplit('-', 1)[1])
+
+            if self.path == '/accounts/get':
+                return self.send_json({
+                    "accounts": [{
+                        "account_id": f"item{item}-account{a}", "mask": "0000", "name": f"Account {a}",
+                        "official_name": None, "type": "depository", "subtype": "checking",
+                        "balances": {"available": 0, "current": 0, "limit": None,
+                                     "iso_currency_code": "CAD", "unofficial_currency_code": None}
+                    } for a in range(ACCOUNTS_PER_ITEM)],
+                    "item": item_details(item),
+                    "request_id": "benchmark"
+                })
+
+            if self.path == '/transactions/get':
+                options_ = request.get('options') or {}
+                account_ids = options_.get('account_ids')
+                matching = [
+                    t for t in reversed(history(item))
+                    if request['start_date'] <= t['date'] <= request['end_date']
+                    and (not account_ids or t['account_id'] in account_ids)
+                ]
+                offset = options_.get('offset', 0)
+                return self.send_json({
+                    "accounts": [],
+                    "transactions": matching[offset:offset + options_.get('count', 100)],
+                    "total_transactions": len(matching),
+                    "item": item_details(item),
+                    "request_id": "benchmark"
+                })
+
+            if self.path != '/transactions/sync':
+                return self.send_json({"error_code": "NOT_FOUND"}, 404)
+
+            offset = int(request.get('cursor') or 0)
+            end = min(offset + options['page_size'], per_item)
+            self.send_json({
+                "accounts": [],
+                "added": [synthetic_transaction(item, i, per_item) for i in range(offset, end)],
+                "modified": [],
+                "removed": [],
+                "next_cursor": str(end),
+                "has_more": end < per_item,
+                "request_id": "benchmark",
+                "transactions_update_status": "HISTORICAL_UPDATE_COMPLETE"
+            })
+
+    return PlaidHandler
+
+
+def firefly_handler(options, stats):
+    """
+    Builds the request handler of the stand-in Firefly III server. It serves the account transactions
+    of a synthetic ledger, searches by external ID, and accepts new, updated and deleted transactions.
+    """
+    lock = threading.Lock()
+    created = {}
+    firefly_accounts = options['items'] * ACCOUNTS_PER_ITEM
+    ledger = [existing_transaction(i, firefly_accounts) for i in range(options['existing'])]
+
+    class FireflyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def send_json(self, body, status=200):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def read_json(self):
+            return json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'{}')
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == '/_stats':
+                return self.send_json(stats.requests)
+
+            account = re.fullmatch(r'/api/v1/accounts/(\w+)/transactions', url.path)
+            stats.count('GET ' + re.sub(r"/\d+", "/{id}", url.path))
+            time.sleep(options['firefly_latency'] / 1000)
+
+            if account:
+                matching = [
+                    t for t in ledger
+                    if t['attributes']['transactions'][0]['source_id'] == account.group(1)
+                    and query.get('start', '') <= t['attributes']['transactions'][0]['date'][:10] <= query.get('end', '9999')
+                ]
+                page = int(query.get('page', 1))
+                limit = int(query.get('limit', 50))
+                links = {}
+                if page * limit < len(matching):
+                    query['page'] = str(page + 1)
+                    links['next'] = f"http://{self.headers['Host']}{url.path}?" + '&'.join(f"{k}={v}" for k, v in query.items())
+                return self.send_json({"data": matching[(page - 1) * limit:page * limit], "links": links})
+            if url.path == '/api/v1/search/transactions':
+                external_id = re.search(r'"(.*)"', query.get('query', ''))
+                with lock:
+                    found = external_id and created.get(external_id.group(1))
+                return self.send_json({"data": [found] if found else [], "links": {}})
+            if url.path.startswith('/api/v1/transactions/'):
+                with lock:
+                    found = created.get(url.path.rsplit('/', 1)[1])
+                return self.send_json({"data": found} if found else {}, 200 if found else 404)
+            self.send_json({}, 404)
+
+        def do_POST(self):
+            body = self.read_json()
+            stats.count('POST /api/v1/transactions')
+            time.sleep(options['firefly_latency'] / 1000)
+            with lock:
+                group_id = str(options['existing'] + len(created) + 1)
+                splits = [dict(split, transaction_journal_id=f"{group_id}{i}") for i, split in enumerate(body['transactions'])]
+                group = {"id": group_id, "attributes": {"transactions": splits}}
+                created[group_id] = group
+                for split in splits:
+                    for external_id in (split.get('external_id') or '').split(', '):
+                        created[external_id] = group
+            self.send_json({"data": group})
+
+        def do_PUT(self):
+            self.read_json()
+            stats.count('PUT /api/v1/transactions/{id}')
+            time.sleep(options['firefly_latency'] / 1000)
+            group_id = self.path.rsplit('/', 1)[1]
+            self.send_json({"data": {"id": group_id, "attributes": {"transactions": []}}})
+
+        def do_DELETE(self):
+            stats.count(f"DELETE {self.path.rsplit('/', 1)[0]}/{{id}}")
+            time.sleep(options['firefly_latency'] / 1000)
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+    return FireflyHandler
+
+
+def run_servers(options, ports):
+    """
+    Runs both stand-in servers. Meant to be started in a separate process, so that
+    their memory and CPU use are not counted against the importer.
+    """
+    plaid_server = ThreadingHTTPServer(('127.0.0.1', 0), plaid_handler(options, Stats()))
+    firefly_server = ThreadingHTTPServer(('127.0.0.1', 0), firefly_handler(options, Stats()))
+    plaid_server.daemon_threads = firefly_server.daemon_threads = True
+    threading.Thread(target=plaid_server.serve_forever, daemon=True).start()
+    ports.put((plaid_server.server_port, firefly_server.server_port))
+    firefly_server.serve_forever()
+
+
+class StageTimer:
+    """
+    Records the latency of every call to the functions it wraps, from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.samples.setdefault(name, []).append(elapsed)
+        return timed
+
+    def report(self):
+        report = {}
+        for name, samples in self.samples.items():
+            samples = sorted(samples)
+            report[name] = {
+                "calls": len(samples),
+                "total_s": round(sum(samples), 3),
+                "mean_ms": round(statistics.fmean(samples) * 1000, 3),
+                "p50_ms": round(samples[len(samples) // 2] * 1000, 3),
+                "p95_ms": round(samples[int(len(samples) * 0.95)] * 1000, 3),
+                "max_ms": round(samples[-1] * 1000, 3)
+            }
+        return report
+
+
+def get_json(url):
+    import requests
+    return requests.get(url, timeout=30).json()
+
+
+def run_sync(importer, options, plaid_url, firefly_url, state_path):
+    """
+    Runs the startup index refresh and one full sync against the stand-in servers.
+
+    Returns:
+        dict: The timings of the run.
+    """
+    import plaid
+    from plaid.api import plaid_api
+
+    timer = StageTimer()
+    config = {
+        'plaid_client_id': 'benchmark', 'plaid_secret': 'benchmark',
+        'plaid_access_tokens': [f'access-benchmark-{i}' for i in range(options['items'])],
+        'firefly_api_key': 'benchmark', 'firefly_base_url': firefly_url,
+        'remove_strings': ["Deposit - ", "Withdrawal - "], 'not_duplicates': [],
+        'match_transactions': options['match'], 'sync_minutes': 10, 'state_path': state_path,
+        'firefly_max_workers': options['firefly_workers'], 'plaid_max_workers': options['plaid_workers'],
+        'firefly_pool_size': max(options['firefly_workers'], 10), 'retries': 0, 'plaid_host': plaid_url
+    }
+    accounts = {
+        f"item{item}-account{a}": str(item * ACCOUNTS_PER_ITEM + a + 1)
+        for item in range(options['items']) for a in range(ACCOUNTS_PER_ITEM)
+    }
+
+    api = plaid_api.PlaidApi(plaid.ApiClient(plaid.Configuration(
+        host=plaid_url, api_key={'clientId': 'benchmark', 'secret': 'benchmark'})))
+    transport = importer.PlaidTransport(config) if options['plaid_transport'] == 'raw' else None
+    sync_api = transport or api
+    sync_api.transactions_sync = timer.wrap('plaid transactions_sync', sync_api.transactions_sync)
+    sync_api.transactions_get = timer.wrap('plaid transactions_get', sync_api.transactions_get)
+    client = importer.PlaidClient(api, config, transport)
+
+    for name in ('firefly_refresh_id_index', 'find_matching_transactions', 'extract_transaction_details',
+                 'firefly_post_transaction', 'update_existing_transaction_with_id', 'write_changes'):
+        setattr(importer, name, timer.wrap(name, getattr(importer, name)))
+
+    state = importer.StateStore(state_path)
+    firefly = importer.FireflyClient(config)
+    firefly_ids = importer.FireflyIdIndex(state)
+    dead_letters = importer.DeadLetterQueue(state)
+
+    start = time.perf_counter()
+    importer.firefly_refresh_id_index(config, firefly, accounts, firefly_ids, state)
+    startup = time.perf_counter() - start
+    if options['backfill']:
+        importer.backfill(config, accounts, client, firefly, firefly_ids, state, dead_letters,
+                          FIRST_DATE, FIRST_DATE + datetime.timedelta(days=730))
+    else:
+        importer.sync(config, accounts, client, firefly, firefly_ids, state, dead_letters)
+    total = time.perf_counter() - start
+
+    return {
+        "startup_s": round(startup, 3),
+        "end_to_end_s": round(total, 3),
+        "transactions_per_s": round(options['transactions'] / (total - startup), 1) if total > startup else None,
+        "ids_indexed": len(firefly_ids),
+        "dead_letters": len(dead_letters),
+        "stages": timer.report()
+    }
+
+
+def run_conversion(importer, options):
+    """
+    Times extract_transaction_details and the duplicate exemption check over the synthetic history,
+    once as raw JSON dicts and once as Plaid model objects.
+
+    Returns:
+        dict: The throughput of each input format.
+    """
+    import plaid
+    from plaid.model.transaction import Transaction
+    from plaid.model_utils import validate_and_convert_types
+
+    config = {
+        'remove_strings': ["EFT Deposit from ", "EFT Withdrawal to ", "Deposit - ", "Withdrawal - ",
+                           "ABM - ", "Bill Payment - "],
+        'not_duplicates': ["Transfer", "Split", "E-Transfer"]
+    }
+    accounts = {f"item0-account{a}": str(a + 1) for a in range(ACCOUNTS_PER_ITEM)}
+
+    raw = []
+    for index in range(options['transactions']):
+        transaction = synthetic_transaction(0, index, options['transactions'])
+        if index % 3 == 0:
+            transaction['name'] = config['remove_strings'][index % 6] + transaction['name']
+        raw.append(transaction)
+
+    # Deserializing into models takes milliseconds each, so a sample is reused for the whole run
+    configuration = plaid.Configuration()
+    sample = [validate_and_convert_types(transaction, (Transaction,), ['received_data'], True, True,
+                                         configuration=configuration)
+              for transaction in raw[:1000]]
+    models = [sample[index % len(sample)] for index in range(len(raw))]
+
+    report = {}
+    for name, transactions in (('raw', raw), ('model', models)):
+        start = time.perf_counter()
+        for transaction in transactions:
+            importer.extract_transaction_details(config, accounts, transaction)
+            importer.is_not_duplicate(config, transaction['name'])
+        elapsed = time.perf_counter() - start
+        report[name] = {
+            "total_s": round(elapsed, 3),
+            "transactions_per_s": round(len(transactions) / elapsed, 1),
+            "us_per_transaction": round(elapsed / len(transactions) * 1_000_000, 2)
+        }
+    return report
+
+
+def print_report(args, report):
+    """
+    Prints the report of a sync run as text.
+    """
+    print(f"Synced {args.transactions} transactions in {report['end_to_end_s']}s "
+          f"({report['transactions_per_s']}/s), startup {report['startup_s']}s, peak RSS {report['peak_rss_mb']} MB")
+    for server, requests in report['requests'].items():
+        print(f"{server} requests: {sum(requests.values())}")
+        for endpoint, count in sorted(requests.items()):
+            print(f"  {endpoint:<45} {count}")
+    print(f"{'stage':<40} {'calls':>8} {'total s':>9} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9}")
+    for name, stage in report['stages'].items():
+        print(f"{name:<40} {stage['calls']:>8} {stage['total_s']:>9} {stage['mean_ms']:>9} "
+              f"{stage['p50_ms']:>9} {stage['p95_ms']:>9} {stage['max_ms']:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a full sync against local Plaid and Firefly III stand-ins.")
+    parser.add_argument('--transactions', type=int, default=10_000, help="Size of the synthetic Plaid history.")
+    parser.add_argument('--items', type=int, default=1, help="Number of Plaid items the history is spread over.")
+    parser.add_argument('--page-size', type=int, default=500, help="Transactions per /transactions/sync page.")
+    parser.add_argument('--plaid-latency', type=float, default=0, help="Milliseconds added to each Plaid request.")
+    parser.add_argument('--firefly-latency', type=float, default=0, help="Milliseconds added to each Firefly request.")
+    parser.add_argument('--existing', type=int, default=0, help="Transactions already in the Firefly ledger.")
+    parser.add_argument('--match', action='store_true', help="Enable match_transactions.")
+    parser.add_argument('--plaid-workers', type=int, default=4)
+    parser.add_argument('--firefly-workers', type=int, default=4)
+    parser.add_argument('--plaid-transport', choices=['plaid', 'raw'], default='plaid',
+                        help="Fetch pages through plaid-python or the raw JSON transport.")
+    parser.add_argument('--backfill', action='store_true',
+                        help="Import the history with the sharded backfill instead of a sync.")
+    parser.add_argument('--conversion', action='store_true',
+                        help="Only time the conversion of transactions to Firefly III payloads.")
+    parser.add_argument('--json', action='store_true', help="Print the report as JSON.")
+    args = parser.parse_args()
+    options = vars(args)
+    options['transactions'] -= options['transactions'] % args.items
+
+    if args.conversion:
+        importer = load_importer()
+        report = run_conversion(importer, options)
+        if args.json:
+            print(json.dumps(report, indent=2))
+            return
+        for name, result in report.items():
+            print(f"Converted {args.transactions} {name} transactions in {result['total_s']}s "
+                  f"({result['transactions_per_s']}/s, {result['us_per_transaction']} us each)")
+        return
+
+    ports = multiprocessing.Queue()
+    servers = multiprocessing.Process(target=run_servers, args=(options, ports), daemon=True)
+    servers.start()
+    plaid_port, firefly_port = ports.get(timeout=60)
+    plaid_url, firefly_url = f"http://127.0.0.1:{plaid_port}", f"http://127.0.0.1:{firefly_port}"
+
+    importer = load_importer()
+    importer.logging.basicConfig(level=importer.logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as directory:
+        report = run_sync(importer, options, plaid_url, firefly_url, os.path.join(directory, 'state.db'))
+
+    report['requests'] = {
+        'plaid': get_json(plaid_url + '/_stats'),
+        'firefly': get_json(firefly_url + '/_stats')
+    }
+    report['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    report['options'] = {k: v for k, v in options.items() if k != 'json'}
+    servers.terminate()
+
+    # Matches replace inserts, so the count only holds without them
+    inserted = report['requests']['firefly'].get('POST /api/v1/transactions', 0)
+    expected = None if args.match else expected_inserts(options)
+    report['expected_inserts'] = expected
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(args, report)
+
+    if expected is not None and inserted != expected:
+        raise SystemExit(f"Inserted {inserted} transactions, but the history groups into {expected}.")
+
+
+if __name__ == "__main__":
+    main()
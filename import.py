@@ -1,16 +1,902 @@
-import plaid
-from plaid.api import plaid_api
-from plaid.model.transactions_sync_request import TransactionsSyncRequest
-from plaid.model.accounts_get_request import AccountsGetRequest
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
 import json
 import toml
 import schedule
 import time
 import logging
 import datetime
+from decimal import Decimal
+import hashlib
+import functools
+import sqlite3
+import threading
+import os
+import pathlib
+import sys
+import importlib
+import argparse
+import queue
+import random
+import re
+import math
+import socket
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# plaid-python is slow to import, so it is only loaded once a call needs the generated API
+PLAID_HOST = 'https://development.plaid.com'
+# Settings a tenant file must set itself, so a household is never synced with another's bank or ledger
+TENANT_KEYS = ('plaid_access_tokens', 'firefly_base_url', 'firefly_api_key')
+
+API_LATENCY = Histogram(
+    'importer_api_request_seconds', 'Latency of Plaid and Firefly III API requests.', ['api', 'endpoint'])
+STAGE_LATENCY = Histogram(
+    'importer_stage_seconds', 'Time spent in each stage of a sync.', ['stage'])
+SYNC_LATENCY = Histogram(
+    'importer_sync_seconds', 'Duration of whole syncs.', buckets=(1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+TRANSACTIONS = Counter(
+    'importer_transactions', 'Plaid transactions handled, by outcome.', ['outcome'])
+CURSOR_LAG = Gauge(
+    'importer_cursor_lag_seconds', 'Seconds since the Plaid sync cursor of an item was last committed.', ['item'])
+POLL_INTERVAL = Gauge(
+    'importer_poll_interval_seconds', 'Current adaptive poll interval of a Plaid item.', ['item'])
+
+
+class StateStore:
+    """
+    Persistent importer state kept in a local SQLite database so that restarts
+    resume where the previous run stopped.
+
+    Access tokens are never written to disk, items are keyed by a hash of their token.
+
+    Args:
+        path (str): The path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Every insert records its ID, so avoid a disk sync per commit. Only a power loss, not a
+        # crash of the importer, can lose the last few commits.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.create_tables()
+
+    def create_tables(self):
+        """
+        Creates the tables of the state that are missing.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cursors (item TEXT PRIMARY KEY, cursor TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS firefly_ids "
+                "(external_id TEXT PRIMARY KEY, group_id TEXT, journal_id TEXT)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS dead_letters (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "external_id TEXT NOT NULL, payload TEXT NOT NULL, error TEXT, "
+                "attempts INTEGER NOT NULL DEFAULT 1, created TEXT NOT NULL, updated TEXT NOT NULL)")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS backfill_shards "
+                "(shard TEXT PRIMARY KEY, transactions INTEGER NOT NULL, completed TEXT NOT NULL)")
+
+    def get_meta(self, key):
+        """
+        Returns a stored state value, or None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        """
+        Stores a state value.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def get_cursor(self, token):
+        """
+        Returns the last committed Plaid sync cursor for an access token, or None.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT cursor FROM cursors WHERE item = ?", (item_key(token),)).fetchone()
+        return row[0] if row else None
+
+    def save_cursor(self, token, cursor):
+        """
+        Atomically commits the Plaid sync cursor for an access token.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cursors (item, cursor) VALUES (?, ?)", (item_key(token), cursor))
+
+    def completed_shards(self):
+        """
+        Returns the keys of the backfill shards already written.
+        """
+        with self.lock:
+            return {row[0] for row in self.db.execute("SELECT shard FROM backfill_shards")}
+
+    def complete_shard(self, shard, transactions):
+        """
+        Checkpoints a backfill shard as written, so a resumed backfill skips it.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO backfill_shards (shard, transactions, completed) VALUES (?, ?, ?)",
+                (shard, transactions, datetime.datetime.now().isoformat(timespec='seconds')))
+
+    def close(self):
+        """
+        Closes the database.
+        """
+        with self.lock:
+            self.db.close()
+
+    @staticmethod
+    def snapshot(path):
+        """
+        Returns an in-memory copy of the state database at path, or an empty state if there is
+        none, for runs whose changes must not be kept. The database is opened read-only, so it is
+        neither created nor changed.
+
+        Args:
+            path (str): The path to the SQLite database file.
+        """
+        copy = StateStore(':memory:')
+        if os.path.exists(path):
+            source = sqlite3.connect(pathlib.Path(path).absolute().as_uri() + '?mode=ro', uri=True)
+            try:
+                with copy.lock:
+                    source.backup(copy.db)
+            finally:
+                source.close()
+            # A database written by an older version may lack the newer tables
+            copy.create_tables()
+        return copy
+
+
+class BloomFilter:
+    """
+    Fixed-size probabilistic set that tells for certain when a key was never added, using about
+    ten bits per key for a 1% false positive rate up to its capacity.
+
+    Args:
+        capacity (int): The number of keys it is sized for.
+        error_rate (float): The false positive rate at capacity.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def positions(self, key):
+        """
+        Returns the bit positions of a key, derived from its hash by double hashing.
+        The filter only lives in memory, so Python's per-process string hash is enough.
+        """
+        h = hash(key) & 0xFFFFFFFFFFFFFFFF
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        Adds a key.
+        """
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class FireflyIdIndex:
+    """
+    On-disk index of the Plaid transaction IDs already present in Firefly III, mapped to the
+    Firefly transaction holding them. Lookups hit the SQLite primary key, fronted by an in-memory
+    Bloom filter so that new IDs, the common case, are rejected without a query. The filter takes
+    about 1.2 bytes per ID and is resized as the ledger grows, so memory stays bounded.
+
+    Args:
+        state (StateStore): The persistent importer state the index lives in.
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.rebuild_filter()
+
+    def rebuild_filter(self):
+        """
+        Rebuilds the Bloom filter from the database, with room for twice the IDs it holds.
+        """
+        with self.state.lock:
+            count = self.state.db.execute("SELECT COUNT(*) FROM firefly_ids").fetchone()[0]
+            bloom = BloomFilter(max(count * 2, 10_000))
+            for (external_id,) in self.state.db.execute("SELECT external_id FROM firefly_ids"):
+                bloom.add(external_id)
+            self.bloom = bloom
+
+    def __contains__(self, external_id):
+        if external_id not in self.bloom:
+            return False
+        with self.state.lock:
+            return self.state.db.execute(
+                "SELECT 1 FROM firefly_ids WHERE external_id = ?", (external_id,)).fetchone() is not None
+
+    def __len__(self):
+        with self.state.lock:
+            return self.state.db.execute("SELECT COUNT(*) FROM firefly_ids").fetchone()[0]
+
+    def get(self, external_id):
+        """
+        Returns the Firefly (group_id, journal_id) holding a Plaid transaction ID, or None.
+        """
+        with self.state.lock:
+            return self.state.db.execute(
+                "SELECT group_id, journal_id FROM firefly_ids WHERE external_id = ?", (external_id,)).fetchone()
+
+    def external_ids(self, group_id, journal_id=None):
+        """
+        Returns every Plaid transaction ID held by a Firefly transaction, or by one of its splits.
+        """
+        with self.state.lock:
+            if journal_id:
+                rows = self.state.db.execute(
+                    "SELECT external_id FROM firefly_ids WHERE group_id = ? AND journal_id = ? ORDER BY rowid",
+                    (group_id, journal_id)).fetchall()
+            else:
+                rows = self.state.db.execute(
+                    "SELECT external_id FROM firefly_ids WHERE group_id = ? ORDER BY rowid", (group_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def journal_ids(self, group_id):
+        """
+        Returns the journal IDs of the splits of a Firefly transaction that hold Plaid transaction IDs.
+        """
+        with self.state.lock:
+            rows = self.state.db.execute(
+                "SELECT DISTINCT journal_id FROM firefly_ids WHERE group_id = ? AND journal_id IS NOT NULL",
+                (group_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def remove(self, external_id):
+        """
+        Forgets a Plaid transaction ID.
+        """
+        with self.state.lock, self.state.db:
+            self.state.db.execute(
+                "DELETE FROM firefly_ids WHERE external_id = ?", (external_id,))
+
+    def add(self, external_id, group_id=None, journal_id=None):
+        """
+        Records a Plaid transaction ID as present in Firefly III.
+        """
+        self.update([(external_id, group_id, journal_id)])
+
+    def update(self, rows):
+        """
+        Records many (external_id, group_id, journal_id) rows in one database transaction.
+        """
+        with self.state.lock, self.state.db:
+            self.state.db.executemany(
+                "INSERT OR REPLACE INTO firefly_ids (external_id, group_id, journal_id) VALUES (?, ?, ?)", rows)
+            for external_id, _, _ in rows:
+                self.bloom.add(external_id)
+        # Re-recorded IDs are counted again too, so this may rebuild early but never too late
+        if self.bloom.count > self.bloom.capacity:
+            self.rebuild_filter()
+
+
+class DeadLetterQueue:
+    """
+    On-disk queue of the Firefly III inserts that failed, kept so they can be replayed
+    after the Plaid cursor has moved past them.
+
+    Args:
+        state (StateStore): The persistent importer state the queue lives in.
+    """
+
+    def __init__(self, state):
+        self.state = state
+
+    def __len__(self):
+        with self.state.lock:
+            return self.state.db.execute("SELECT COUNT(*) FROM dead_letters").fetchone()[0]
+
+    def push(self, payload, error):
+        """
+        Stores a failed Firefly III payload.
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.state.lock, self.state.db:
+            self.state.db.execute(
+                "INSERT INTO dead_letters (external_id, payload, error, created, updated) VALUES (?, ?, ?, ?, ?)",
+                (payload['transactions'][0]['external_id'], json.dumps(payload), error, now, now))
+
+    def items(self, limit=None, ids=None):
+        """
+        Returns stored entries as (id, payload, error, attempts, created), least recently tried first.
+
+        Args:
+            limit (int): The most entries to return.
+            ids (list): Only return these entries.
+        """
+        query = "SELECT id, payload, error, attempts, created FROM dead_letters"
+        params = []
+        if ids:
+            query += f" WHERE id IN ({', '.join('?' * len(ids))})"
+            params += ids
+        query += " ORDER BY updated, id"
+        if limit:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.state.lock:
+            rows = self.state.db.execute(query, params).fetchall()
+        return [(row[0], json.loads(row[1]), row[2], row[3], row[4]) for row in rows]
+
+    def failed(self, entry_id, error):
+        """
+        Records another failed attempt of an entry.
+        """
+        now = datetime.datetime.now().isoformat(timespec='seconds')
+        with self.state.lock, self.state.db:
+            self.state.db.execute(
+                "UPDATE dead_letters SET error = ?, attempts = attempts + 1, updated = ? WHERE id = ?",
+                (error, now, entry_id))
+
+    def discard(self, external_id):
+        """
+        Takes the ID of a transaction Plaid removed out of the stored entries, so a replay doesn't
+        insert it. Splits left without IDs are dropped, and so are entries left without splits.
+
+        Args:
+            external_id (str): The Plaid ID of the removed transaction.
+
+        Returns:
+            int: The number of entries changed or removed.
+        """
+        changed = 0
+        with self.state.lock, self.state.db:
+            rows = self.state.db.execute(
+                "SELECT id, payload FROM dead_letters WHERE instr(payload, ?) > 0", (external_id,)).fetchall()
+            for entry_id, data in rows:
+                payload = json.loads(data)
+                splits = []
+                for split in payload['transactions']:
+                    ids = [i for i in split['external_id'].split(', ') if i != external_id]
+                    if ids:
+                        splits.append({**split, 'external_id': ', '.join(ids)})
+                if splits == payload['transactions']:
+                    continue
+                changed += 1
+                if not splits:
+                    self.state.db.execute("DELETE FROM dead_letters WHERE id = ?", (entry_id,))
+                    continue
+                payload['transactions'] = splits
+                self.state.db.execute(
+                    "UPDATE dead_letters SET external_id = ?, payload = ? WHERE id = ?",
+                    (splits[0]['external_id'], json.dumps(payload), entry_id))
+        return changed
+
+    def remove(self, ids=None):
+        """
+        Removes entries, or every entry if no IDs are given.
+        """
+        with self.state.lock, self.state.db:
+            if ids is None:
+                self.state.db.execute("DELETE FROM dead_letters")
+            else:
+                self.state.db.executemany(
+                    "DELETE FROM dead_letters WHERE id = ?", [(i,) for i in ids])
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread calling an API, so bursts stay within the server's throttle.
+
+    Args:
+        rate (float): The sustained number of requests per second. 0 disables the limit.
+        burst (int): The number of requests that may be sent at once after an idle period.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes one token from the bucket, sleeping until it is available.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            # Reserve the token now so concurrent callers queue up behind each other
+            self.tokens -= 1
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class CircuitOpenError(Exception):
+    """
+    Raised instead of calling an API whose circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an API after repeated failures, so an unavailable server isn't hammered on every sync.
+    Once the cool-down has passed calls are let through again, and the first failure reopens the circuit.
+
+    Args:
+        name (str): The name of the API, used in log messages.
+        threshold (int): The number of consecutive failed calls that opens the circuit.
+        reset_seconds (float): How long the circuit stays open.
+    """
+
+    def __init__(self, name, threshold=5, reset_seconds=300):
+        self.name = name
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.failures = 0
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def is_open(self):
+        """
+        Returns True while calls should not be made.
+        """
+        with self.lock:
+            return self.failures >= self.threshold and time.monotonic() - self.opened < self.reset_seconds
+
+    def check(self):
+        """
+        Raises CircuitOpenError while calls should not be made.
+        """
+        if self.is_open():
+            raise CircuitOpenError(f"{self.name} is unavailable, not calling it until the circuit breaker resets.")
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.failures == self.threshold:
+                    logging.error(f"{self.name} keeps failing. Pausing calls for {self.reset_seconds:.0f}s.")
+                self.opened = time.monotonic()
+
+
+class RetryPolicy:
+    """
+    Jittered exponential backoff between retries of a failed call.
+
+    Args:
+        config (dict): The configuration details.
+    """
+
+    def __init__(self, config):
+        self.retries = config.get('retries', 4)
+        self.base_seconds = config.get('retry_base_seconds', 1)
+        self.max_seconds = config.get('retry_max_seconds', 60)
+
+    def delay(self, attempt, retry_after=None):
+        """
+        Returns the seconds to wait before retrying, honouring the server's Retry-After if it sent one.
+
+        Args:
+            attempt (int): The number of the attempt that failed, starting at 0.
+            retry_after (str): The Retry-After header of the failed response, in seconds or as an HTTP date.
+        """
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_seconds)
+            except ValueError:
+                try:
+                    wait = parsedate_to_datetime(retry_after) - datetime.datetime.now(datetime.timezone.utc)
+                    return min(max(wait.total_seconds(), 0), self.max_seconds)
+                except (TypeError, ValueError):
+                    pass
+        return random.uniform(0, min(self.max_seconds, self.base_seconds * 2 ** attempt))
+
+
+class PlaidError(Exception):
+    """
+    An error response of the raw Plaid transport, with the status and headers a plaid.ApiException has.
+    """
+
+    def __init__(self, status, headers, body):
+        super().__init__(f"({status}) {body}")
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+
+class PlaidTransaction:
+    """
+    Compact record of a Plaid transaction holding only the fields the importer reads, with empty
+    location and payment details dropped. Reads like a dict, so it can stand in for one.
+
+    Args:
+        data (dict): The transaction as decoded from /transactions/sync.
+    """
+
+    __slots__ = ('transaction_id', 'account_id', 'amount', 'date', 'name', 'merchant_name', 'website',
+                 'iso_currency_code', 'category', 'counterparties', 'location', 'payment_meta',
+                 'payment_channel', 'personal_finance_category')
+
+    def __init__(self, data):
+        for field in self.__slots__:
+            setattr(self, field, data.get(field))
+        self.location = {key: value for key, value in (self.location or {}).items() if value}
+        self.payment_meta = {'payment_processor': (self.payment_meta or {}).get('payment_processor')}
+        category = self.personal_finance_category or {}
+        self.personal_finance_category = {'primary': category.get('primary'), 'detailed': category.get('detailed')}
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        return getattr(self, field, default)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.__slots__}
+
+
+class PlaidTransport:
+    """
+    Posts /transactions/sync and /transactions/get straight over a pooled keep-alive session and decodes the response
+    with orjson if it is installed, into compact PlaidTransaction records. This skips the type-checked model objects
+    plaid-python builds for every transaction, which cost more CPU than the rest of a sync.
+    Other Plaid calls are rare and keep going through the generated API.
 
-cursors = []
+    Args:
+        config (dict): The configuration details.
+    """
+
+    def __init__(self, config):
+        self.host = config.get('plaid_host', PLAID_HOST)
+        self.timeout = config.get('plaid_timeout', 60)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=config.get('plaid_max_workers', 4))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'PLAID-CLIENT-ID': config['plaid_client_id'],
+            'PLAID-SECRET': config['plaid_secret'],
+            'Plaid-Version': '2020-09-14',
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, deflate'
+        })
+
+    def transactions_sync(self, request):
+        """
+        Fetches one page of /transactions/sync.
+
+        Args:
+            request (dict): The request.
+
+        Returns:
+            dict: The decoded response, with the added and modified transactions as PlaidTransaction records.
+        """
+        response = self.session.post(
+            self.host + '/transactions/sync', data=json.dumps(request), timeout=self.timeout)
+        if response.status_code != 200:
+            raise PlaidError(response.status_code, response.headers, response.text)
+        page = orjson.loads(response.content) if orjson else response.json()
+        for kind in ('added', 'modified'):
+            page[kind] = [PlaidTransaction(transaction) for transaction in page[kind]]
+        return page
+
+    def transactions_get(self, request):
+        """
+        Fetches one page of /transactions/get.
+
+        Args:
+            request (dict): The request.
+
+        Returns:
+            dict: The decoded response, with the transactions as PlaidTransaction records.
+        """
+        response = self.session.post(
+            self.host + '/transactions/get', data=json.dumps(request, default=str), timeout=self.timeout)
+        if response.status_code != 200:
+            raise PlaidError(response.status_code, response.headers, response.text)
+        page = orjson.loads(response.content) if orjson else response.json()
+        page['transactions'] = [PlaidTransaction(transaction) for transaction in page['transactions']]
+        return page
+
+
+def plaid_errors():
+    """
+    Returns the exception types of failed Plaid responses. plaid.ApiException can only be raised
+    once plaid-python is loaded, so it is not imported just to be caught.
+    """
+    plaid = sys.modules.get('plaid')
+    return (PlaidError, plaid.ApiException) if plaid else (PlaidError,)
+
+
+class PlaidClient:
+    """
+    Wraps the generated Plaid API so every call is retried with backoff and goes through a circuit breaker.
+    All Plaid calls made by the importer are reads, so they are safe to retry.
+
+    Args:
+        api (plaid_api.PlaidApi): The Plaid API. Built from the configuration when first needed if None.
+        config (dict): The configuration details.
+        transport (PlaidTransport): Serves the calls it implements instead of the generated API, if given.
+    """
+
+    def __init__(self, api, config, transport=None):
+        self.api = api
+        self.config = config
+        self.transport = transport
+        self.lock = threading.Lock()
+        self.retry = RetryPolicy(config)
+        self.breaker = CircuitBreaker(
+            'Plaid', config.get('circuit_breaker_failures', 5), config.get('circuit_breaker_reset_minutes', 5) * 60)
+
+    def generated_api(self):
+        """
+        Returns the generated Plaid API, importing plaid-python and building it on first use.
+        """
+        with self.lock:
+            if self.api is None:
+                import plaid
+                from plaid.api import plaid_api
+                configuration = plaid.Configuration(
+                    host=self.config.get('plaid_host', PLAID_HOST),
+                    api_key={
+                        'clientId': self.config['plaid_client_id'],
+                        'secret': self.config['plaid_secret'],
+                    }
+                )
+                self.api = plaid_api.PlaidApi(plaid.ApiClient(configuration))
+            return self.api
+
+    def make_request(self, name, **fields):
+        """
+        Builds the request of a Plaid call: a plain dict if the transport serves the call,
+        otherwise the plaid-python request model, such as TransactionsSyncRequest for transactions_sync.
+
+        Args:
+            name (str): The name of the call.
+            **fields: The fields of the request. Fields set to None are left out.
+        """
+        fields = {key: value for key, value in fields.items() if value is not None}
+        if hasattr(self.transport, name):
+            return fields
+        module = importlib.import_module(f'plaid.model.{name}_request')
+        return getattr(module, name.title().replace('_', '') + 'Request')(**fields)
+
+    def __getattr__(self, name):
+        method = getattr(self.transport, name, None) or getattr(self.generated_api(), name)
+
+        def call(*args, **kwargs):
+            self.breaker.check()
+            for attempt in range(self.retry.retries + 1):
+                try:
+                    with API_LATENCY.labels('plaid', name).time():
+                        response = method(*args, **kwargs)
+                except plaid_errors() as e:
+                    if e.status != 429 and e.status < 500:
+                        raise
+                    if attempt == self.retry.retries:
+                        self.breaker.failure()
+                        raise
+                    retry_after = e.headers.get('Retry-After') if e.headers else None
+                except (urllib3.exceptions.HTTPError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    if attempt == self.retry.retries:
+                        self.breaker.failure()
+                        raise
+                    retry_after = None
+                else:
+                    self.breaker.success()
+                    return response
+                logging.info(f"Plaid {name} failed, retrying (attempt {attempt + 1}).")
+                time.sleep(self.retry.delay(attempt, retry_after))
+
+        return call
+
+
+def plaid_client(config):
+    """
+    Builds the Plaid client of a configuration. The generated Plaid API is only built once a call
+    needs it, and the raw transport is used if plaid_transport is "raw".
+
+    Args:
+        config (dict): The configuration details.
+
+    Returns:
+        PlaidClient: The Plaid client.
+    """
+    transport = PlaidTransport(config) if config.get('plaid_transport') == 'raw' else None
+    return PlaidClient(None, config, transport)
+
+
+class FireflyClient:
+    """
+    Shared HTTP client for the Firefly III API. All calls go through one pooled keep-alive
+    session so that the authentication headers are built once and connections are reused,
+    and through one rate limiter so concurrent writers respect Firefly's throttle.
+
+    Failed requests are retried with backoff when that is safe: any request rejected with a 429,
+    and GET, PUT and DELETE requests that fail with a server error or a network error.
+    Repeated failures open a circuit breaker that makes further calls fail fast.
+
+    Args:
+        config (dict): The configuration details.
+    """
+
+    def __init__(self, config):
+        self.base_url = config['firefly_base_url']
+        self.timeout = config.get('firefly_timeout', 30)
+        self.limiter = RateLimiter(
+            config.get('firefly_rate_limit', 0), config.get('firefly_rate_burst', 10))
+        self.retry = RetryPolicy(config)
+        self.breaker = CircuitBreaker(
+            'Firefly', config.get('circuit_breaker_failures', 5), config.get('circuit_breaker_reset_minutes', 5) * 60)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=config.get('firefly_pool_size', 10))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'Authorization': f"Bearer {config['firefly_api_key']}",
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'Accept-Encoding': 'gzip, deflate'
+        })
+
+    def request(self, method, path, action=None, **kwargs):
+        """
+        Sends a request to Firefly III.
+
+        Args:
+            method (str): The HTTP method.
+            path (str): The API path, or a full URL such as a pagination link.
+            action (str): What a write does, for plans to name it. Not sent to Firefly III.
+
+        Returns:
+            requests.Response: The response from Firefly III.
+        """
+        url = path if path.startswith('http') else self.base_url + path
+        endpoint = f"{method} {re.sub(r'/[0-9]+', '/{id}', urlparse(url).path)}"
+        kwargs.setdefault('timeout', self.timeout)
+        # A POST may have been applied before it failed, so only retry it when Firefly rejected it outright
+        idempotent = method != 'POST'
+        self.breaker.check()
+
+        for attempt in range(self.retry.retries + 1):
+            last_attempt = attempt == self.retry.retries
+            self.limiter.acquire()
+            try:
+                with API_LATENCY.labels('firefly', endpoint).time():
+                    response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or last_attempt:
+                    self.breaker.failure()
+                    raise
+                retry_after = None
+            else:
+                retryable = response.status_code == 429 or (idempotent and response.status_code >= 500)
+                if not retryable or last_attempt:
+                    if response.status_code >= 500:
+                        self.breaker.failure()
+                    else:
+                        self.breaker.success()
+                    return response
+                retry_after = response.headers.get('Retry-After')
+            logging.info(f"Firefly {method} {path} failed, retrying (attempt {attempt + 1}).")
+            time.sleep(self.retry.delay(attempt, retry_after))
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+class PlanRecorder(FireflyClient):
+    """
+    Firefly III client for plan mode. Reads are sent to Firefly as usual but writes never are:
+    each one is written to a JSONL stream instead and answered with a synthetic success, so the
+    rest of the sync carries on as if it had been applied.
+
+    Args:
+        config (dict): The configuration details.
+        output (file): Where the planned writes go, one JSON object per line.
+    """
+
+    def __init__(self, config, output):
+        super().__init__(config)
+        self.output = output
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.planned = 0
+
+    def request(self, method, path, action=None, **kwargs):
+        if method == 'GET':
+            return super().request(method, path, **kwargs)
+
+        body = json.loads(kwargs['data']) if kwargs.get('data') else None
+        split = body['transactions'][0] if body else {}
+        # Writes that don't name their action are told apart by their method and body
+        if action is None:
+            if method == 'POST':
+                action = 'insert'
+            elif method == 'DELETE':
+                action = 'delete'
+            elif set(split) <= {'transaction_journal_id', 'external_id'}:
+                # Only setting the external ID links Plaid IDs to an existing transaction
+                action = 'merge_ids'
+            else:
+                action = 'update'
+
+        with self.lock:
+            self.planned += 1
+            planned_id = f'planned-{self.planned}'
+            self.counts[action] = self.counts.get(action, 0) + 1
+            self.output.write(json.dumps({'action': action, 'method': method, 'path': path, 'body': body}) + '\n')
+
+        response = requests.Response()
+        response.status_code = 204 if method == 'DELETE' else 200
+        splits = body['transactions'] if body else [{}]
+        response._content = json.dumps({'data': {
+            'id': planned_id,
+            'attributes': {'transactions': [
+                {**split, 'transaction_journal_id': f'{planned_id}-{index}'} for index, split in enumerate(splits)
+            ]}
+        }}).encode()
+        return response
+
+
+def item_key(token):
+    """
+    Returns a stable, non-secret key for a Plaid access token.
+
+    Args:
+        token (str): The Plaid access token.
+
+    Returns:
+        str: The key used to store state for the item.
+    """
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
 
 
 def read_config(config_filename):
@@ -43,7 +929,7 @@ def display_plaid_accounts(config, client):
     accounts = []
 
     for token in config['plaid_access_tokens']:
-        request = AccountsGetRequest(access_token=token)
+        request = client.make_request('accounts_get', access_token=token)
         response = client.accounts_get(request)
         accounts += response['accounts']
 
@@ -85,78 +971,120 @@ def display_possible_plaid_values(plaid_transactions):
     print(unique_values)
 
 
-def plaid_sync_transactions(client, config):
+def plaid_sync_pages(client, token, cursor):
     """
-    Syncs transactions from Plaid. On the first run, this function will return all transactions.
-    To handle multiple access tokens, this function uses a global list to store cursors for each token.
+    Syncs transactions for one Plaid item one page at a time. Without a cursor, this will return all transactions.
 
     Args:
         client (plaid.Client): The Plaid client.
-        config (dict): The configuration details.
-    Returns:
-        list: A list of transactions from Plaid.
+        token (str): The Plaid access token of the item.
+        cursor (str): The last committed cursor for the item, or None.
+
+    Yields:
+        tuple: A dictionary of the added, modified and removed transactions of the page,
+               and the cursor to commit once they are written.
     """
-    global cursors
+    has_more = True
 
-    transactions = []
+    while has_more:
+        request = client.make_request('transactions_sync', access_token=token, cursor=cursor)
 
-    for i in range(len(config['plaid_access_tokens'])):
-        # Use existing cursor if available
-        if cursors[i]:
-            request = TransactionsSyncRequest(
-                access_token=config['plaid_access_tokens'][i],
-                cursor=cursors[i]
-            )
-        else:
-            request = TransactionsSyncRequest(
-                access_token=config['plaid_access_tokens'][i],
-            )
-
-        response = client.transactions_sync(request)
-        transactions += response['added']
-        cursors[i] = response['next_cursor']
-
-        # Get transactions from Plaid
-        while (response['has_more']):
-            request = TransactionsSyncRequest(
-                access_token=config['plaid_access_tokens'][i],
-                cursor=cursors[i]
-            )
+        with STAGE_LATENCY.labels('plaid_sync').time():
             response = client.transactions_sync(request)
-            transactions += response['added']
-            cursors[i] = response['next_cursor']
+        cursor = response['next_cursor']
+        has_more = response['has_more']
+        yield {kind: response[kind] for kind in ('added', 'modified', 'removed')}, cursor
+
 
-    return transactions
+def plaid_sync_transactions(client, token, cursor):
+    """
+    Syncs transactions for one Plaid item. Without a cursor, this function will return all transactions.
+
+    Args:
+        client (plaid.Client): The Plaid client.
+        token (str): The Plaid access token of the item.
+        cursor (str): The last committed cursor for the item, or None.
+    Returns:
+        tuple: A dictionary of the added, modified and removed transactions,
+               and the cursor to commit once they are written.
+    """
+    changes = {'added': [], 'modified': [], 'removed': []}
+
+    # Get transactions from Plaid
+    for page, cursor in plaid_sync_pages(client, token, cursor):
+        for kind in changes:
+            changes[kind] += page[kind]
+
+    return changes, cursor
 
 
-def firefly_get_transactions(config, accounts):
+def prefetch(iterable):
     """
-    Fetches existing transactions from Firefly III.
+    Iterates over an iterable while its next item is produced in a background thread,
+    so that fetching the next page overlaps with writing the current one.
 
     Args:
-        config (dict): The configuration details.
-        accounts (dict): The account details.
+        iterable (iterable): The iterable to read ahead of, such as plaid_sync_pages.
 
-    Returns:
-        list: A list of firefly transactions.
+    Yields:
+        The items of the iterable. Exceptions raised by it are raised here.
     """
-    firefly_api_key = config['firefly_api_key']
-    firefly_base_url = config['firefly_base_url']
-    headers = {
-        'Authorization': f'Bearer {firefly_api_key}',
-        'Content-Type': 'application/json'
-    }
+    items = queue.Queue(maxsize=1)
+    done = object()
+    stopped = threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+                if stopped.is_set():
+                    return
+            items.put(done)
+        except Exception as e:
+            items.put(e)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = items.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Let the producer exit if the consumer stopped early
+        stopped.set()
+        while not items.empty():
+            items.get_nowait()
+
+
+def firefly_get_transactions(firefly, accounts, start=None, end=None):
+    """
+    Fetches existing transactions from Firefly III one page at a time.
 
-    for account in accounts.values():
-        url = f"{firefly_base_url}/api/v1/accounts/{account}/transactions"
-        response = requests.get(url, headers=headers).json()
-        transactions = response['data']
-        while (response['links'].get('next')):
-            response = requests.get(
-                response['links']['next'], headers=headers).json()
-            transactions += response['data']
+    Args:
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        start (datetime.date): Only fetch transactions on or after this date. Fetches all if None.
+        end (datetime.date): Only fetch transactions on or before this date.
 
-    return transactions
+    Yields:
+        dict: The firefly transactions of every mapped account.
+    """
+    params = {}
+    if start:
+        params['start'] = start.isoformat()
+    if end:
+        params['end'] = end.isoformat()
+
+    for account in set(accounts.values()):
+        response = firefly.get(
+            f"/api/v1/accounts/{account}/transactions", params=params).json()
+        yield from response['data']
+        while (response['links'].get('next')):
+            response = firefly.get(response['links']['next']).json()
+            yield from response['data']
 
 
 def firefly_filter_for_transaction_ids(firefly_transactions):
@@ -164,17 +1092,56 @@ def firefly_filter_for_transaction_ids(firefly_transactions):
     Filters the existing transactions for transaction IDs.
 
     Args:
-        firefly_transactions (list): The firefly transactions.
+        firefly_transactions (iterable): The firefly transactions.
 
-    Returns:
-        firefly_ids: A set of transaction IDs.
+    Yields:
+        tuple: The (external_id, group_id, journal_id) of every Plaid transaction ID found.
     """
-
-    firefly_ids = set()
     for item in firefly_transactions:
-        firefly_ids.update(item['attributes']['transactions']
-                           [0]['external_id'].split(', '))
-    return firefly_ids
+        for split in item['attributes']['transactions']:
+            if not split.get('external_id'):
+                continue
+            for external_id in split['external_id'].split(', '):
+                yield external_id, item['id'], split['transaction_journal_id']
+
+
+def firefly_refresh_id_index(config, firefly, accounts, firefly_ids, state):
+    """
+    Brings the external ID index up to date with Firefly III. After the first full scan only
+    transactions dated since the last refresh, minus an overlap window, are fetched again.
+    The index is kept up to date by every insert, so this is skipped entirely if the last refresh
+    was less than id_index_refresh_hours ago. This keeps frequent one-shot runs fast.
+
+    Args:
+        config (dict): The configuration details.
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        firefly_ids (FireflyIdIndex): The external ID index.
+        state (StateStore): The persistent importer state.
+    """
+    refreshed = state.get_meta('firefly_ids_refreshed')
+    if refreshed and time.time() - float(refreshed) < config.get('id_index_refresh_hours', 24) * 3600:
+        logging.info(f"External ID index holds {len(firefly_ids)} IDs, refreshed recently.")
+        return
+
+    today = datetime.date.today()
+    watermark = state.get_meta('firefly_ids_watermark')
+    start = None
+    if watermark:
+        start = datetime.date.fromisoformat(watermark) - datetime.timedelta(
+            days=config.get('id_index_overlap_days', 30))
+
+    rows = []
+    for row in firefly_filter_for_transaction_ids(firefly_get_transactions(firefly, accounts, start)):
+        rows.append(row)
+        if len(rows) >= 500:
+            firefly_ids.update(rows)
+            rows = []
+    firefly_ids.update(rows)
+
+    state.set_meta('firefly_ids_watermark', today.isoformat())
+    state.set_meta('firefly_ids_refreshed', str(time.time()))
+    logging.info(f"External ID index holds {len(firefly_ids)} IDs.")
 
 
 def clean_transaction_account_name(config, name):
@@ -188,126 +1155,189 @@ def clean_transaction_account_name(config, name):
     Returns:
         str: The cleaned transaction account name.
     """
-    for string in config['remove_strings']:
-        name = name.replace(string, '')
+    pattern = substring_pattern(tuple(config['remove_strings']))
+    if pattern:
+        name = pattern.sub('', name)
     return name.title()
 
 
-def find_matching_transactions(config, plaid_transaction):
+@functools.lru_cache(maxsize=None)
+def substring_pattern(strings):
+    """
+    Compiles a list of literal strings into one regex matching any of them, longest first.
+    Compiled once per list, so transactions are scanned in a single pass instead of once per string.
+
+    Args:
+        strings (tuple): The strings to match.
+
+    Returns:
+        re.Pattern: The pattern, or None if there are no strings.
+    """
+    strings = sorted(filter(None, strings), key=len, reverse=True)
+    return re.compile('|'.join(map(re.escape, strings))) if strings else None
+
+
+def is_not_duplicate(config, name):
     """
-    Finds matching transactions between Firefly III and Plaid.
+    Checks if a transaction name contains one of the not_duplicates strings, which exempt it from
+    being treated as a duplicate of the transaction before it.
 
     Args:
         config (dict): The configuration details.
-        plaid_transaction (dict): The transaction from Plaid.
+        name (str): The transaction name.
 
     Returns:
-        list: A list of matching transaction IDs.
+        boolean: True if the transaction should be posted even if it looks like a duplicate.
     """
+    pattern = substring_pattern(tuple(config['not_duplicates']))
+    return bool(pattern and pattern.search(name))
 
-    p_date = plaid_transaction['date']
-    if plaid_transaction['amount'] < 0:
-        p_amount = abs(plaid_transaction['amount'])
-        p_type = 'deposit'
-    else:
-        p_amount = plaid_transaction['amount']
-        p_type = 'withdrawal'
-
-    firefly_api_key = config['firefly_api_key']
-    firefly_base_url = config['firefly_base_url']
-    headers = {
-        'Authorization': f'Bearer {firefly_api_key}',
-        'Content-Type': 'application/json'
-    }
 
-    query = {
-        "type": p_type,
-        "amount": p_amount,
-        "date_on": p_date.isoformat(),
-        "has_any_external_id": "false"
-    }
+@functools.lru_cache(maxsize=None)
+def note_label(key):
+    """
+    Returns the note label of a Plaid field, such as Postal Code for postal_code.
+    """
+    return key.replace('_', ' ').title()
 
-    params = {
-        "query": ' && '.join([f"{key}:{value}" for key, value in query.items()]),
-    }
 
-    url = f"{firefly_base_url}/api/v1/search/transactions"
-    response = requests.get(url, headers=headers, params=params)
-    if response.status_code != 200:
-        logging.error(
-            f"Failed to get matching transactions. Status code: {response.status_code}")
-        return []
+def match_key(date, transaction_type, amount):
+    """
+    Builds the key used to match Plaid transactions with Firefly III transactions.
 
-    matching = []
+    Args:
+        date (datetime.date or str): The transaction date, or a Firefly ISO timestamp.
+        transaction_type (str): The Firefly transaction type, withdrawal or deposit.
+        amount (float or str): The positive transaction amount.
 
-    # has_any_external_id is not working, so we have to filter manually
-    for match in response.json()['data']:
-        if not match['attributes']['transactions'][0]['external_id']:
-            matching.append(match)
+    Returns:
+        tuple: The (date, type, amount) key.
+    """
+    return str(date)[:10], transaction_type, Decimal(str(amount)).quantize(Decimal('0.01'))
+
+
+@STAGE_LATENCY.labels('match').time()
+def find_matching_transactions(firefly, accounts, plaid_transactions):
+    """
+    Fetches the Firefly III transactions without an external ID that could match a batch of Plaid transactions.
+    This makes one request per account over the date range of the batch instead of one search per transaction.
+
+    Args:
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        plaid_transactions (list): The transactions from Plaid.
+
+    Returns:
+        dict: The journal IDs of the unmatched firefly transactions, keyed by (date, type, amount) and then by Firefly ID.
+    """
+    unmatched = {}
+    if not plaid_transactions:
+        return unmatched
+
+    dates = [datetime.date.fromisoformat(str(t['date'])) for t in plaid_transactions]
+    plaid_accounts = {t['account_id'] for t in plaid_transactions}
+    batch_accounts = {k: v for k, v in accounts.items() if k in plaid_accounts}
+
+    for item in firefly_get_transactions(firefly, batch_accounts, min(dates), max(dates)):
+        split = item['attributes']['transactions'][0]
+        # has_any_external_id is not working in search, so we filter manually
+        if split['external_id']:
+            continue
+        key = match_key(split['date'], split['type'], split['amount'])
+        unmatched.setdefault(key, {})[item['id']] = split['transaction_journal_id']
 
-    return response.json()['data']
+    return unmatched
 
 
-def update_existing_transaction_with_id(config, firefly_id, plaid_id):
+def update_existing_transaction_with_id(firefly, firefly_id, plaid_id, journal_id=None):
     """
     Updates an existing transaction in Firefly III with a Plaid transaction ID.
 
     Args:
-        firefly_transaction (dict): The transaction from Firefly III.
-        plaid_transaction_id (str): The ID of the transaction from Plaid.
-    """
-    firefly_api_key = config['firefly_api_key']
-    firefly_base_url = config['firefly_base_url']
-    headers = {
-        'Authorization': f'Bearer {firefly_api_key}',
-        'Content-Type': 'application/json'
-    }
+        firefly (FireflyClient): The Firefly III client.
+        firefly_id (str): The ID of the transaction from Firefly III.
+        plaid_id (str): The ID of the transaction from Plaid.
+        journal_id (str): The journal ID of the split to update, if known.
 
+    Returns:
+        boolean: True if the transaction was updated, False otherwise.
+    """
     payload = {
         "transactions": [
             {
-                "transaction_journal_id": firefly_id,
+                "transaction_journal_id": journal_id or firefly_id,
                 "external_id": plaid_id
             }
         ]
     }
 
-    response = requests.put(
-        f'{firefly_base_url}/api/v1/transactions/{firefly_id}', headers=headers, data=json.dumps(payload))
+    response = firefly.put(
+        f'/api/v1/transactions/{firefly_id}', data=json.dumps(payload))
     if response.status_code == 200:
         logging.info(f"Transaction '{plaid_id}' updated successfully.")
-    else:
-        logging.error(
-            f"Failed to update transaction '{plaid_id}'. Status code: {response.status_code}")
+        return True
+
+    logging.error(
+        f"Failed to update transaction '{plaid_id}'. Status code: {response.status_code}")
+    return False
+
+
+def merge_transaction_ids(firefly, firefly_ids, firefly_id, journal_id, split):
+    """
+    Links a Plaid transaction and its duplicates to the existing Firefly III transaction it was
+    matched to, with one PUT setting all of their IDs, and records them once it succeeded.
+
+    Args:
+        firefly (FireflyClient): The Firefly III client.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        firefly_id (str): The ID of the matched transaction from Firefly III.
+        journal_id (str): The journal ID of the matched split.
+        split (list): The Plaid transaction followed by its duplicates.
+
+    Returns:
+        boolean: True if the IDs were set, False otherwise.
+    """
+    plaid_ids = [t['transaction_id'] for t in split]
+    if not update_existing_transaction_with_id(firefly, firefly_id, ', '.join(plaid_ids), journal_id):
+        TRANSACTIONS.labels('failed').inc()
+        return False
 
+    firefly_ids.update([(plaid_id, firefly_id, journal_id) for plaid_id in plaid_ids])
+    TRANSACTIONS.labels('matched').inc()
+    return True
 
-def match_transaction(config, transaction):
+
+@STAGE_LATENCY.labels('match').time()
+def match_transaction(unmatched, transaction):
     """
     Matches a Plaid transaction with existing transactions in Firefly III.
+    A matched transaction is removed from the unmatched transactions so it cannot be matched twice.
 
     Args:
-        config (dict): The configuration details.
-        plaid_transaction (dict): The transaction from Plaid.
+        unmatched (dict): The unmatched firefly transactions from find_matching_transactions.
+        transaction (dict): The transaction from Plaid.
 
     Returns:
-        boolean: True if one match is found and updated, False otherwise.
+        tuple: The Firefly transaction ID and journal ID of the only match, or None.
     """
-    matching = find_matching_transactions(
-        config, transaction)
+    if transaction['amount'] < 0:
+        key = match_key(transaction['date'], 'deposit', abs(transaction['amount']))
+    else:
+        key = match_key(transaction['date'], 'withdrawal', transaction['amount'])
+
+    matching = unmatched.get(key, {})
     if len(matching) == 1:
-        firefly_id = matching[0]['id']
+        firefly_id, journal_id = matching.popitem()
         logging.info(
             f"Firefly transaction {firefly_id} matches plaid transaction {transaction['name']} on {transaction['date']} for {transaction['amount']}")
-
-        update_existing_transaction_with_id(
-            config, firefly_id, transaction['transaction_id'])
-        return True
+        return firefly_id, journal_id
     elif len(matching) > 1:
         logging.info("Multiple matches found. Not updating.")
 
-    return False
+    return None
 
 
+@STAGE_LATENCY.labels('convert').time()
 def extract_transaction_details(config, accounts, transaction):
     """
     Extracts the transaction details from Plaid to a Firefly III format
@@ -330,54 +1360,59 @@ def extract_transaction_details(config, accounts, transaction):
         transaction_id, transaction_type, logo-url, merchant_entity_id, website
     """
 
-    notes = ""
+    # Plaid model objects are converted once, as each of their item lookups is slow
+    if not isinstance(transaction, (dict, PlaidTransaction)):
+        transaction = transaction.to_dict()
+
+    notes = []
 
     # Account name
+    counterparties = transaction['counterparties'] or ()
     if transaction['merchant_name']:
         other_account = transaction['merchant_name']
-    elif transaction['counterparties']:
-        if transaction['counterparties'][0]['name']:
-            other_account = transaction['counterparties'][0]['name']
+    elif counterparties and counterparties[0]['name']:
+        other_account = counterparties[0]['name']
     else:
         other_account = clean_transaction_account_name(
             config, transaction['name'])
 
-    if transaction['counterparties']:
-        for counterparty in transaction['counterparties']:
-            if counterparty['type']:
-                notes += f"Counterparty Type: {counterparty['type']},\n"
-            if counterparty['website']:
-                notes += f"Website: {counterparty['website']},\n"
-            elif transaction['website']:
-                notes += f"Website: {transaction['website']},\n"
-            if counterparty['phone_number']:
-                notes += f"Phone: {counterparty['phone_number']},\n"
-
-    for item in transaction['location'].to_dict():
-        if transaction['location'][item]:
-            notes += f"{item.replace('_', ' ').title()}: {transaction['location'][item]},\n"
+    for counterparty in counterparties:
+        if counterparty['type']:
+            notes.append(f"Counterparty Type: {counterparty['type']}")
+        if counterparty['website']:
+            notes.append(f"Website: {counterparty['website']}")
+        elif transaction['website']:
+            notes.append(f"Website: {transaction['website']}")
+        if counterparty['phone_number']:
+            notes.append(f"Phone: {counterparty['phone_number']}")
+
+    location = transaction['location']
+    for item, value in location.items():
+        if value:
+            notes.append(f"{note_label(item)}: {value}")
 
     if transaction['payment_meta']['payment_processor']:
-        notes += f'Payment Processor: {transaction["payment_meta"]["payment_processor"]},\n'
+        notes.append(f'Payment Processor: {transaction["payment_meta"]["payment_processor"]}')
 
-    notes += f'Payment Channel: {transaction["payment_channel"]},\n'
-    # notes += f'Transaction Type: {transaction["transaction_type"]},\n' deprecated
-    notes += f'Primary Category: {transaction["personal_finance_category"]["primary"]},\n'
-    notes += f'Detailed Category: {transaction["personal_finance_category"]["detailed"]}\n'
+    notes.append(f'Payment Channel: {transaction["payment_channel"]}')
+    # notes.append(f'Transaction Type: {transaction["transaction_type"]}') deprecated
+    notes.append(f'Primary Category: {transaction["personal_finance_category"]["primary"]}')
+    notes.append(f'Detailed Category: {transaction["personal_finance_category"]["detailed"]}')
 
+    date = transaction['date']
     converted_transaction = {
-        "date": transaction['date'].isoformat(),
+        "date": date if isinstance(date, str) else date.isoformat(),
         "description": transaction['name'],
         "external_id": transaction['transaction_id'],
         "currency_code": transaction['iso_currency_code'],
         "tags": transaction['category'],
-        "notes": notes
+        "notes": ",\n".join(notes) + "\n"
     }
 
-    if transaction['location']['lat'] and transaction['location']['lon']:
+    if location.get('lat') and location.get('lon'):
         converted_transaction.update({
-            "latitude": transaction['location']['lat'],
-            "longitude": transaction['location']['lon']
+            "latitude": location['lat'],
+            "longitude": location['lon']
         })
 
     # Transaction amount has to be positive number
@@ -403,162 +1438,1470 @@ def extract_transaction_details(config, accounts, transaction):
     return payload
 
 
-def insert_transactions(config, accounts, plaid_transactions, firefly_ids):
+def firefly_find_by_external_id(firefly, external_id):
     """
-    Inserts new transactions into Firefly III.
+    Finds the Firefly III transaction holding a Plaid transaction ID.
 
     Args:
-        config (dict): The configuration details.
-        accounts (dict): The account details.
-        plaid_transactions (list): The transactions from Plaid.
-        firefly_ids (list): The existing external transaction ids from Firefly III.
-    """
-    firefly_api_key = config['firefly_api_key']
-    firefly_base_url = config['firefly_base_url']
-    headers = {
-        'Authorization': f'Bearer {firefly_api_key}',
-        'Content-Type': 'application/json',
-        'Accept': 'application/json'
-    }
+        firefly (FireflyClient): The Firefly III client.
+        external_id (str): The ID of the transaction from Plaid.
 
-    last_transaction = {
-        "amount": None
-    }
-    last_transaction_matched = False
+    Returns:
+        dict: The firefly transaction, or None if there is none.
+    """
+    params = {"query": f'external_id_contains:"{external_id}"'}
+    response = firefly.get("/api/v1/search/transactions", params=params)
+    response.raise_for_status()
+    for match in response.json()['data']:
+        if external_id in (match['attributes']['transactions'][0]['external_id'] or '').split(', '):
+            return match
+    return None
 
-    for transaction in plaid_transactions:
 
-        if transaction['transaction_id'] in firefly_ids:
-            logging.debug(
-                f"Transaction '{transaction['name']}' already exists in Firefly. Skipping insertion.")
-            continue
+def firefly_post_transaction(firefly, payload):
+    """
+    Creates a transaction in Firefly III. When the outcome of a POST is unknown, because of a network error
+    or a server error, Firefly is first searched for its external ID so a retry can't insert it twice.
 
-        if transaction['account_id'] not in accounts.keys():
-            continue
+    Args:
+        firefly (FireflyClient): The Firefly III client.
+        payload (dict): The transaction in a Firefly III format.
 
-        if transaction['amount'] == last_transaction['amount'] and transaction['name'] == last_transaction['name']:
-            # In some cases, for myself using tangerine to split a transaction, the transaction is duplicated
-            # You can provide a list of strings that if found in the name, will not be considered duplicates
-
-            # Transactions cannot be set to 0 in firefly, so we apppend an id to the existing transaction
-            if not any(match in transaction['name'] for match in config['not_duplicates']):
-                logging.info(
-                    f'Appending ID for duplicate transaction: {transaction["name"]} on {transaction["date"]}')
-                if not last_transaction_matched:
-                    combined_id = f'{last_transaction["transaction_id"]}, {transaction["transaction_id"]}'
-                    firefly_id = json.loads(response.text)['data']['id']
-                    update_existing_transaction_with_id(
-                        config, firefly_id, combined_id)
-                    firefly_ids.add(transaction['transaction_id'])
-                    continue
-                else:
-                    # Edge case where importing a duplicate transaction already matches an existing one and no insertion has been made yet.
-                    match_transaction(config, transaction)
-                    firefly_ids.add(transaction['transaction_id'])
-                    continue
+    Returns:
+        tuple: The created firefly transaction, or None if it could not be created, and the last status code.
+    """
+    # A split can hold several Plaid IDs, any one of them finds the transaction
+    external_id = payload['transactions'][0]['external_id'].split(', ')[0]
+    status_code = None
+
+    for attempt in range(firefly.retry.retries + 1):
+        try:
+            response = firefly.post(
+                '/api/v1/transactions', data=json.dumps(payload))
+            status_code = response.status_code
+            if status_code == 200:
+                return json.loads(response.text)['data'], status_code
+            if status_code < 500:
+                return None, status_code
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logging.info(f"Failed to send transaction '{external_id}': {e}")
+
+        if attempt == firefly.retry.retries:
+            break
+        time.sleep(firefly.retry.delay(attempt))
+        try:
+            existing = firefly_find_by_external_id(firefly, external_id)
+        except requests.RequestException as e:
+            logging.error(f"Unable to check if transaction '{external_id}' was inserted: {e}")
+            break
+        if existing:
+            return existing, 200
+
+    return None, status_code
+
+
+def insert_transaction_group(config, firefly, accounts, group, firefly_ids, dead_letters=None):
+    """
+    Inserts a planned group of Plaid transactions into Firefly III with a single request.
+    Each split of the group becomes a split of one Firefly transaction, and the IDs of the
+    duplicates of a split are set on it from the start. If the insert fails, the payload is
+    stored in the dead-letter queue.
 
-        last_transaction = transaction
+    Args:
+        config (dict): The configuration details.
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        group (list): The splits of the transaction, each a Plaid transaction followed by its duplicates.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay, if anywhere.
 
-        if config['match_transactions']:
-            if match_transaction(config, transaction):
-                last_transaction_matched = True
-                continue
-            else:
-                last_transaction_matched = False
+    Returns:
+        boolean: True if the transaction was written, False otherwise.
+    """
+    transaction = group[0][0]
+    splits = []
+    for split in group:
+        details = extract_transaction_details(config, accounts, split[0])['transactions'][0]
+        # Transactions cannot be set to 0 in firefly, so duplicates only add their ID
+        details['external_id'] = ', '.join(t['transaction_id'] for t in split)
+        splits.append(details)
+    payload = {'transactions': splits}
+    if len(splits) > 1:
+        payload['group_title'] = transaction['name']
+
+    # Only the request counts towards the write stage, as the conversion has its own
+    with STAGE_LATENCY.labels('firefly_write').time():
+        data, status_code = firefly_post_transaction(firefly, payload)
+
+    if not data:
+        logging.error(
+            f"Failed to insert transaction '{transaction['name']}'. Status code: {status_code}")
+        # Like inserted, counted by Firefly split, as the duplicates are counted on their own
+        TRANSACTIONS.labels('failed').inc(len(group))
+        if dead_letters is not None:
+            dead_letters.push(payload, f"Status code: {status_code}")
+        return False
 
-        payload = extract_transaction_details(config, accounts, transaction)
+    logging.info(
+        f"Transaction '{transaction['name']}' inserted successfully.")
+    TRANSACTIONS.labels('inserted').inc(len(group))
+    firefly_ids.update(list(firefly_filter_for_transaction_ids([data])))
 
-        response = requests.post(
-            firefly_base_url + '/api/v1/transactions', headers=headers, data=json.dumps(payload))
+    return True
 
-        if response.status_code == 200:
-            logging.info(
-                f"Transaction '{transaction['name']}' inserted successfully.")
-            firefly_ids.add(transaction['transaction_id'])
-        else:
+
+class PendingGroups:
+    """
+    Carries the duplicate planning of insert_transactions from one Plaid page to the next, so a
+    duplicate or split at the start of a page is grouped with the transaction it repeats at the end
+    of the previous page, as if the whole sync was one batch. The group of the last transaction of
+    each account is held back instead of written, until a later transaction of the account shows it
+    is complete or the sync ends.
+    """
+
+    def __init__(self):
+        self.last_transactions = {}
+        self.groups = []
+        self.matches = {}
+
+    def transaction_ids(self):
+        """
+        Returns:
+            set: The Plaid IDs of the transactions held back.
+        """
+        return {t['transaction_id'] for group in self.groups for split in group for t in split}
+
+
+def insert_transactions(config, firefly, accounts, plaid_transactions, firefly_ids, dead_letters=None,
+                        pending=None, flush=False):
+    """
+    Inserts new transactions into Firefly III.
+
+    The batch is planned in order first, since duplicate detection depends on the previous transaction
+    of the same account. A repeated transaction is a duplicate whose ID is added to the previous one,
+    unless its name is in not_duplicates, in which case it is a split of the same Firefly transaction.
+    Each planned Firefly transaction is then written with one request, with up to
+    firefly_max_workers requests in flight at once. A transaction matched to an existing one is
+    linked to it with a single PUT setting its ID and those of its duplicates.
+
+    Args:
+        config (dict): The configuration details.
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        plaid_transactions (list): The transactions from Plaid.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay, if anywhere.
+        pending (PendingGroups): The planning carried over from the previous pages of a sync, if any.
+            The trailing group of each account is held back in it rather than written.
+        flush (bool): Write every group held back in pending, as no page follows.
+
+    Returns:
+        boolean: True if every transaction was written, held back or kept for replay, False if any
+        insertion or match was lost.
+    """
+    # The last transaction of each account, whether it was matched, and the group and split it is written with
+    last_transactions = pending.last_transactions if pending is not None else {}
+    groups = []
+    # The Firefly transaction and journal IDs each matched group is linked to, by id() of the group
+    matches = pending.matches if pending is not None else {}
+
+    unmatched = {}
+    if config['match_transactions']:
+        unmatched = find_matching_transactions(firefly, accounts, [
+            t for t in plaid_transactions
+            if t['account_id'] in accounts and t['transaction_id'] not in firefly_ids
+        ])
+
+    for transaction in plaid_transactions:
+
+        if transaction['transaction_id'] in firefly_ids:
+            logging.debug(
+                f"Transaction '{transaction['name']}' already exists in Firefly. Skipping insertion.")
+            TRANSACTIONS.labels('skipped').inc()
+            continue
+
+        if transaction['account_id'] not in accounts.keys():
+            continue
+
+        last_transaction, last_transaction_matched, last_group, last_split = last_transactions.get(
+            transaction['account_id'], ({"amount": None}, False, None, None))
+
+        # Duplicates are only looked for among consecutive transactions of one account on one day,
+        # so batches split by account and date group them exactly as the whole batch would be
+        repeated = (transaction['amount'] == last_transaction['amount'] and transaction['name'] == last_transaction['name']
+                    and str(transaction['date']) == str(last_transaction['date']))
+        # In some cases, for myself using tangerine to split a transaction, the transaction is duplicated
+        # You can provide a list of strings that if found in the name, will not be considered duplicates
+        if repeated and not is_not_duplicate(config, transaction['name']):
+            logging.info(
+                f'Appending ID for duplicate transaction: {transaction["name"]} on {transaction["date"]}')
+            TRANSACTIONS.labels('duplicate').inc()
+            last_split.append(transaction)
+            continue
+
+        match = match_transaction(unmatched, transaction) if config['match_transactions'] else None
+        split = [transaction]
+        if match:
+            # Duplicates of a matched transaction are linked to the same Firefly transaction
+            group = [split]
+            groups.append(group)
+            matches[id(group)] = match
+        elif repeated and not last_transaction_matched:
+            # Not a duplicate, but part of the same purchase, so it becomes another split
+            group = last_group
+            group.append(split)
+        else:
+            group = [split]
+            groups.append(group)
+        last_transactions[transaction['account_id']] = (transaction, bool(match), group, split)
+
+    if pending is not None:
+        groups = pending.groups + groups
+        if flush:
+            # Later transactions are no longer grouped with the ones written now
+            pending.groups = []
+            last_transactions.clear()
+        else:
+            trailing = {id(group) for _, _, group, _ in last_transactions.values()}
+            pending.groups = [group for group in groups if id(group) in trailing]
+            groups = [group for group in groups if id(group) not in trailing]
+
+    if not groups:
+        return True
+
+    def write(group):
+        if id(group) in matches:
+            firefly_id, journal_id = matches.pop(id(group))
+            return merge_transaction_ids(firefly, firefly_ids, firefly_id, journal_id, group[0]), True
+        return insert_transaction_group(config, firefly, accounts, group, firefly_ids, dead_letters), False
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=config.get('firefly_max_workers', 4)) as executor:
+        results = list(executor.map(write, groups))
+    elapsed = time.monotonic() - start
+
+    written = sum(len(split) for group, (result, _) in zip(groups, results) if result for split in group)
+    logging.info(
+        f"Wrote {written} of {sum(len(split) for group in groups for split in group)} transactions to Firefly in {elapsed:.2f}s "
+        f"({written / elapsed if elapsed else 0:.1f}/s).")
+
+    # Failed inserts are kept for replay, but a failed match is only retried by the next sync
+    return all(result or (not matched and dead_letters is not None) for result, matched in results)
+
+
+def split_update_payload(firefly_ids, firefly_id, journal_id, split):
+    """
+    Builds the body of a PUT that changes one split of a Firefly III transaction. The other splits
+    of a multi-split transaction are listed by journal ID only, so Firefly keeps them as they are.
+
+    Args:
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        firefly_id (str): The ID of the transaction from Firefly III.
+        journal_id (str): The journal ID of the split, if known.
+        split (dict): The fields of the split to change.
+
+    Returns:
+        dict: The body of the PUT.
+    """
+    split["transaction_journal_id"] = journal_id or firefly_id
+    others = [
+        {"transaction_journal_id": other} for other in firefly_ids.journal_ids(firefly_id)
+        if str(other) != str(split["transaction_journal_id"])
+    ]
+    return {"transactions": [split] + others}
+
+
+def update_transactions(config, firefly, accounts, plaid_transactions, firefly_ids):
+    """
+    Updates the Firefly III transactions of Plaid transactions that were modified, for example
+    a pending transaction that posted or an amount that was corrected.
+
+    Args:
+        config (dict): The configuration details.
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        plaid_transactions (list): The modified transactions from Plaid.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+
+    Returns:
+        boolean: True if every transaction was updated, False if any update failed.
+    """
+    succeeded = True
+
+    for transaction in plaid_transactions:
+        if transaction['account_id'] not in accounts.keys():
+            continue
+
+        existing = firefly_ids.get(transaction['transaction_id'])
+        if not existing or not existing[0]:
+            logging.debug(
+                f"Modified transaction '{transaction['name']}' is not linked to a Firefly transaction. Skipping update.")
+            continue
+        firefly_id, journal_id = existing
+
+        split = extract_transaction_details(config, accounts, transaction)['transactions'][0]
+        # Keep the IDs of any duplicates that were appended to this split
+        split["external_id"] = ', '.join(firefly_ids.external_ids(firefly_id, journal_id))
+        payload = split_update_payload(firefly_ids, firefly_id, journal_id, split)
+
+        response = firefly.put(
+            f'/api/v1/transactions/{firefly_id}', data=json.dumps(payload))
+        if response.status_code == 200:
+            logging.info(
+                f"Transaction '{transaction['name']}' updated successfully.")
+            TRANSACTIONS.labels('updated').inc()
+        else:
             logging.error(
-                f"Failed to insert transaction '{transaction['name']}'. Status code: {response.status_code}")
+                f"Failed to update transaction '{transaction['name']}'. Status code: {response.status_code}")
+            succeeded = False
 
+    return succeeded
 
-def sync(config, accounts, client, firefly_ids):
+
+def remove_transactions(config, firefly, plaid_transactions, firefly_ids, dead_letters=None):
     """
-    Syncs transactions between Plaid and Firefly III.
+    Deletes or tags the Firefly III transactions of Plaid transactions that were removed,
+    depending on removed_transactions. A split still holding the IDs of other Plaid transactions
+    only has the removed ID taken off, and only the split is deleted from a multi-split transaction.
+    Removed transactions whose insert failed are taken out of the dead-letter queue instead.
+
+    Args:
+        config (dict): The configuration details.
+        firefly (FireflyClient): The Firefly III client.
+        plaid_transactions (list): The removed transactions from Plaid.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay, if anywhere.
+
+    Returns:
+        boolean: True if every transaction was removed, False if any removal failed.
+    """
+    action = config.get('removed_transactions', 'delete')
+    succeeded = True
+
+    for transaction in plaid_transactions:
+        plaid_id = transaction['transaction_id']
+        if dead_letters is not None and dead_letters.discard(plaid_id):
+            logging.info(f"Removed transaction '{plaid_id}' taken out of the dead-letter queue.")
+        existing = firefly_ids.get(plaid_id)
+        if not existing or not existing[0]:
+            continue
+        firefly_id, journal_id = existing
+        split_ids = firefly_ids.external_ids(firefly_id, journal_id)
+        remaining = [i for i in split_ids if i != plaid_id]
+        other_splits = len(firefly_ids.external_ids(firefly_id)) > len(split_ids)
+
+        if remaining:
+            split = {"external_id": ', '.join(remaining)}
+        elif action == 'tag':
+            response = firefly.get(f'/api/v1/transactions/{firefly_id}')
+            if response.status_code != 200:
+                logging.error(
+                    f"Failed to get removed transaction '{plaid_id}'. Status code: {response.status_code}")
+                succeeded = False
+                continue
+            splits = response.json()['data']['attributes']['transactions']
+            tags = next((s['tags'] for s in splits if str(s['transaction_journal_id']) == str(journal_id)),
+                        splits[0]['tags']) or []
+            split = {"tags": tags + [config.get('removed_tag', 'plaid-removed')]}
+        elif action == 'delete':
+            if other_splits:
+                response = firefly.delete(f'/api/v1/transaction-journals/{journal_id}')
+            else:
+                response = firefly.delete(f'/api/v1/transactions/{firefly_id}')
+            if response.status_code in (200, 204, 404):
+                logging.info(f"Removed transaction '{plaid_id}' deleted successfully.")
+                TRANSACTIONS.labels('removed').inc()
+                firefly_ids.remove(plaid_id)
+            else:
+                logging.error(
+                    f"Failed to delete removed transaction '{plaid_id}'. Status code: {response.status_code}")
+                succeeded = False
+            continue
+        else:
+            continue
+
+        response = firefly.put(
+            f'/api/v1/transactions/{firefly_id}',
+            data=json.dumps(split_update_payload(firefly_ids, firefly_id, journal_id, split)),
+            action='remove_id' if remaining else 'tag_removed')
+        if response.status_code == 200:
+            logging.info(f"Removed transaction '{plaid_id}' updated successfully.")
+            TRANSACTIONS.labels('removed').inc()
+            firefly_ids.remove(plaid_id)
+        else:
+            logging.error(
+                f"Failed to update removed transaction '{plaid_id}'. Status code: {response.status_code}")
+            succeeded = False
+
+    return succeeded
+
+
+def write_changes(config, firefly, accounts, changes, firefly_ids, dead_letters=None, pending=None):
+    """
+    Writes the added, modified and removed transactions of a Plaid sync to Firefly III, in that order.
+    Modified transactions that were never imported are inserted instead. Groups held back in pending
+    are written first if the page modifies or removes any of their transactions.
+
+    Args:
+        config (dict): The configuration details.
+        firefly (FireflyClient): The Firefly III client.
+        accounts (dict): The account details.
+        changes (dict): The added, modified and removed transactions from Plaid.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay, if anywhere.
+        pending (PendingGroups): The planning carried over from the previous pages of a sync, if any.
+
+    Returns:
+        boolean: True if every change was written, held back or kept for replay, False otherwise.
+    """
+    flushed = True
+    changed_ids = {t['transaction_id'] for t in changes['modified'] + changes['removed']}
+    if pending is not None and not changed_ids.isdisjoint(pending.transaction_ids()):
+        flushed = insert_transactions(config, firefly, accounts, [], firefly_ids, dead_letters, pending, flush=True)
+
+    modified = [t for t in changes['modified'] if t['transaction_id'] in firefly_ids]
+    added = changes['added'] + [t for t in changes['modified'] if t['transaction_id'] not in firefly_ids]
+
+    # Run every step so one failure doesn't hold back the others
+    results = [
+        flushed,
+        insert_transactions(config, firefly, accounts, added, firefly_ids, dead_letters, pending),
+        update_transactions(config, firefly, accounts, modified, firefly_ids),
+        remove_transactions(config, firefly, changes['removed'], firefly_ids, dead_letters)
+    ]
+    return all(results)
+
+
+def replay_dead_letters(firefly, dead_letters, firefly_ids, limit=None, ids=None):
+    """
+    Inserts the transactions kept in the dead-letter queue into Firefly III again.
+    Entries that succeed, or whose transactions are already in Firefly III, are removed from the queue.
+
+    Args:
+        firefly (FireflyClient): The Firefly III client.
+        dead_letters (DeadLetterQueue): The dead-letter queue.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        limit (int): The most entries to replay.
+        ids (list): Only replay these entries.
+
+    Returns:
+        tuple: The number of entries replayed and the number that failed again.
+    """
+    replayed = failed = 0
+
+    for entry_id, payload, _, _, _ in dead_letters.items(limit, ids):
+        plaid_ids = payload['transactions'][0]['external_id'].split(', ')
+        if plaid_ids[0] in firefly_ids:
+            dead_letters.remove([entry_id])
+            continue
+
+        data, status_code = firefly_post_transaction(firefly, payload)
+        if not data:
+            dead_letters.failed(entry_id, f"Status code: {status_code}")
+            failed += 1
+            continue
+
+        firefly_ids.update(list(firefly_filter_for_transaction_ids([data])))
+        dead_letters.remove([entry_id])
+        TRANSACTIONS.labels('replayed').inc()
+        replayed += 1
+
+    if replayed or failed:
+        logging.info(f"Replayed {replayed} dead-lettered transactions, {failed} failed again.")
+    return replayed, failed
+
+
+def record_cursor_commit(token):
+    """
+    Restarts the cursor lag metric of a Plaid item.
+
+    Args:
+        token (str): The Plaid access token of the item.
+    """
+    committed = time.time()
+    CURSOR_LAG.labels(item_key(token)).set_function(lambda: time.time() - committed)
+
+
+def share_writers(config, parallel):
+    """
+    Splits the firefly_max_workers writers between batches written in parallel, so together they
+    send no more requests at once than one batch would and stay within the Firefly connection pool.
+
+    Args:
+        config (dict): The configuration details.
+        parallel (int): The number of batches written at the same time.
+
+    Returns:
+        dict: The configuration details each batch is written with.
+    """
+    return {**config, 'firefly_max_workers': max(config.get('firefly_max_workers', 4) // max(parallel, 1), 1)}
+
+
+def sync_item(config, accounts, client, firefly, firefly_ids, state, token, dead_letters=None):
+    """
+    Streams the transactions of one Plaid item into Firefly III. Each page is written while the
+    next one is fetched, and its cursor is committed once all of its changes are written.
+    Only one page is held in memory at a time, whatever the size of the history, besides the last
+    group of each account, which is held back until the next page can no longer add a duplicate
+    to it. The cursor committed meanwhile is the one a restart would fetch those groups again from.
 
     Args:
         config (dict): The configuration details.
         accounts (dict): The account details.
         client (plaid.Client): The Plaid client.
-        firefly_ids (list): The existing transactions from Firefly III.
+        firefly (FireflyClient): The Firefly III client.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        state (StateStore): The persistent importer state.
+        token (str): The Plaid access token of the item.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay, if anywhere.
+
+    Returns:
+        int: The number of added and modified transactions, or None if the item stopped at a failed page.
+    """
+    start_cursor = state.get_cursor(token)
+
+    for attempt in range(3):
+        changed = 0
+        pending = PendingGroups()
+        # The page each held back transaction arrived in and the cursor it was fetched from
+        held_since = {}
+        committed = cursor = start_cursor
+        try:
+            for page, (changes, next_cursor) in enumerate(prefetch(plaid_sync_pages(client, token, start_cursor))):
+                if not write_changes(config, firefly, accounts, changes, firefly_ids, dead_letters, pending):
+                    logging.warning(
+                        f"Not all changes of Plaid item {item_key(token)} were written. The next sync will retry from the previous cursor.")
+                    return None
+                held_since = {i: held_since.get(i, (page, cursor)) for i in pending.transaction_ids()}
+                cursor = next_cursor
+                resume = min(held_since.values(), key=lambda held: held[0])[1] if held_since else cursor
+                if resume != committed:
+                    state.save_cursor(token, resume)
+                    record_cursor_commit(token)
+                    committed = resume
+                changed += len(changes['added']) + len(changes['modified'])
+
+            if not insert_transactions(config, firefly, accounts, [], firefly_ids, dead_letters, pending, flush=True):
+                logging.warning(
+                    f"Not all changes of Plaid item {item_key(token)} were written. The next sync will retry from the previous cursor.")
+                return None
+            if cursor != committed:
+                state.save_cursor(token, cursor)
+                record_cursor_commit(token)
+            return changed
+        except Exception as e:
+            # Plaid requires pagination to restart from its first cursor if the item changed while paging.
+            # Pages already written are skipped through the external ID index.
+            if 'TRANSACTIONS_SYNC_MUTATION_DURING_PAGINATION' not in str(e) or attempt == 2:
+                raise
+            logging.info(f"Plaid item {item_key(token)} changed during pagination. Restarting.")
+
+    return None
+
+
+@SYNC_LATENCY.time()
+def sync(config, accounts, client, firefly, firefly_ids, state, dead_letters, tokens=None, item_schedule=None):
     """
+    Syncs transactions between Plaid and Firefly III.
+    Inserts that failed in previous syncs are replayed first, up to dead_letter_replay_limit of them.
+    Items are synced in parallel, bounded by plaid_max_workers, each streaming its pages into Firefly III
+    with its share of the firefly_max_workers writers.
+    A failing item is logged and retried on the next sync without affecting the others.
+
+    Args:
+        config (dict): The configuration details.
+        accounts (dict): The account details.
+        client (PlaidClient): The Plaid client.
+        firefly (FireflyClient): The Firefly III client.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        state (StateStore): The persistent importer state.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay.
+        tokens (list): The access tokens of the items to sync. If None, syncs the items that are due
+            in item_schedule, or every item if there is no schedule.
+        item_schedule (ItemSchedule): The adaptive poll schedule to update with each item's activity, if any.
+
+    Returns:
+        boolean: True if every item was synced, False if the sync was skipped or any item failed.
+    """
+    if tokens is None and item_schedule:
+        tokens = item_schedule.due()
+        if not tokens:
+            return True
+
+    for breaker in (client.breaker, firefly.breaker):
+        if breaker.is_open():
+            logging.warning(f"{breaker.name} circuit breaker is open. Skipping sync.")
+            return False
+
     logging.info("Syncing...")
-    plaid_transactions = plaid_sync_transactions(client, config)
-    insert_transactions(
-        config, accounts, plaid_transactions, firefly_ids)
+    try:
+        replay_dead_letters(firefly, dead_letters, firefly_ids, config.get('dead_letter_replay_limit', 50))
+    except Exception as e:
+        logging.error(f"Failed to replay dead-lettered transactions: {e}")
+
+    if tokens is None:
+        tokens = config['plaid_access_tokens']
+    succeeded = True
+    workers = min(config.get('plaid_max_workers', 4), len(tokens))
+    item_config = share_writers(config, workers)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = {
+            executor.submit(
+                sync_item, item_config, accounts, client, firefly, firefly_ids, state, token, dead_letters): token
+            for token in tokens
+        }
+        for future in as_completed(futures):
+            token = futures[future]
+            changed = None
+            try:
+                changed = future.result()
+            except Exception as e:
+                logging.error(
+                    f"Failed to sync Plaid item {item_key(token)}: {e}")
+            if item_schedule:
+                item_schedule.record(token, changed)
+            succeeded = succeeded and changed is not None
+
+    return succeeded
+
+
+class ItemSchedule:
+    """
+    Adapts how often each Plaid item is polled to how often it actually has new transactions.
+    An item's interval is halved after a sync that added or modified transactions and grows by
+    half after a quiet one, bounded by min_sync_minutes and max_sync_minutes. Intervals are kept
+    in the state database so they survive restarts.
+
+    Args:
+        config (dict): The configuration details.
+        state (StateStore): The persistent importer state.
+    """
+
+    def __init__(self, config, state):
+        self.state = state
+        self.tokens = config['plaid_access_tokens']
+        self.min_seconds = config.get('min_sync_minutes', config['sync_minutes']) * 60
+        self.max_seconds = config.get('max_sync_minutes', 24 * 60) * 60
+        self.initial_seconds = min(max(config['sync_minutes'] * 60, self.min_seconds), self.max_seconds)
+        self.lock = threading.Lock()
+        self.items = {}
+        for token in self.tokens:
+            stored = state.get_meta(f'schedule:{item_key(token)}')
+            interval, next_sync = json.loads(stored) if stored else (self.initial_seconds, 0)
+            self.items[token] = [min(max(interval, self.min_seconds), self.max_seconds), next_sync]
+            POLL_INTERVAL.labels(item_key(token)).set(self.items[token][0])
+
+    def due(self):
+        """
+        Returns the access tokens of the items whose next poll is due.
+        """
+        now = time.time()
+        with self.lock:
+            return [token for token in self.tokens if self.items[token][1] <= now]
+
+    def record(self, token, changed):
+        """
+        Adapts an item's interval to the outcome of a sync and schedules its next poll.
+
+        Args:
+            token (str): The Plaid access token of the item.
+            changed (int): The number of added and modified transactions, or None if the sync failed.
+                A failed sync keeps the interval as it is.
+        """
+        with self.lock:
+            if token not in self.items:
+                return
+            interval = self.items[token][0]
+            if changed:
+                interval = max(interval / 2, self.min_seconds)
+            elif changed is not None:
+                interval = min(interval * 1.5, self.max_seconds)
+            self.items[token] = [interval, time.time() + interval]
+            self.state.set_meta(f'schedule:{item_key(token)}', json.dumps(self.items[token]))
+        POLL_INTERVAL.labels(item_key(token)).set(interval)
+        logging.debug(f"Polling Plaid item {item_key(token)} every {interval / 60:.0f} minutes.")
+
+
+class WebhookTriggers:
+    """
+    Collects the Plaid items named by webhooks and releases each one a debounce period after its
+    first webhook, so a burst of webhooks for an item causes a single sync.
+
+    Args:
+        debounce_seconds (float): How long to collect webhooks for an item before syncing it.
+    """
+
+    def __init__(self, debounce_seconds):
+        self.debounce_seconds = debounce_seconds
+        self.pending = {}
+        self.condition = threading.Condition()
+
+    def add(self, token):
+        """
+        Schedules a sync of an item, unless one is already pending.
+        """
+        with self.condition:
+            self.pending.setdefault(token, time.monotonic())
+            self.condition.notify()
+
+    def wait(self, timeout):
+        """
+        Waits up to timeout seconds for items whose debounce period has passed.
+
+        Returns:
+            list: The access tokens of the items to sync, possibly empty.
+        """
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                due = [token for token, first in self.pending.items() if now - first >= self.debounce_seconds]
+                if due:
+                    for token in due:
+                        del self.pending[token]
+                    return due
+                next_due = min([first + self.debounce_seconds for first in self.pending.values()] + [deadline])
+                if next_due <= now:
+                    return []
+                self.condition.wait(next_due - now)
+
+
+def plaid_item_ids(client, config, state):
+    """
+    Maps the Plaid item IDs, which webhooks refer to, to their access tokens.
+    Item IDs never change, so they are only looked up once and then kept in the state database.
+
+    Args:
+        client (PlaidClient): The Plaid client.
+        config (dict): The configuration details.
+        state (StateStore): The persistent importer state.
+
+    Returns:
+        dict: The access token of each item ID.
+    """
+    item_tokens = {}
+    for token in config['plaid_access_tokens']:
+        item_id = state.get_meta(f'item_id:{item_key(token)}')
+        if not item_id:
+            item_id = client.item_get(client.make_request('item_get', access_token=token))['item']['item_id']
+            state.set_meta(f'item_id:{item_key(token)}', item_id)
+        item_tokens[item_id] = token
+    return item_tokens
+
+
+def start_webhook_server(config, item_tokens, triggers):
+    """
+    Starts the embedded receiver for Plaid webhooks in a background thread.
+    A TRANSACTIONS SYNC_UPDATES_AVAILABLE webhook schedules a sync of the item it names.
+
+    Webhooks are not verified, so the port should not be reachable by anyone but Plaid's
+    relay, for example behind a reverse proxy. A forged webhook can only cause an extra sync.
+
+    Args:
+        config (dict): The configuration details.
+        item_tokens (dict): The access token of each Plaid item ID.
+        triggers (WebhookTriggers): Where the items to sync are collected.
+
+    Returns:
+        ThreadingHTTPServer: The running server.
+    """
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logging.debug(format, *args)
+
+        def do_POST(self):
+            try:
+                webhook = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)))
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+
+            # Always acknowledge, otherwise Plaid keeps retrying webhooks we don't act on
+            self.send_response(200)
+            self.end_headers()
+
+            if webhook.get('webhook_type') != 'TRANSACTIONS' or webhook.get('webhook_code') != 'SYNC_UPDATES_AVAILABLE':
+                return
+            token = item_tokens.get(webhook.get('item_id'))
+            if token:
+                logging.info(f"Plaid has new transactions for item {item_key(token)}.")
+                triggers.add(token)
+
+    server = ThreadingHTTPServer(
+        (config.get('webhook_address', '0.0.0.0'), config['webhook_port']), WebhookHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class LeaseTable:
+    """
+    Shares tenants between worker processes through a lease table in a SQLite database that every
+    worker can open, on the same host or on a shared volume with working file locks. Each worker
+    heartbeats, owns the tenants it holds an unexpired lease on, and takes only its fair share of
+    tenants, so tenants move between workers as they join and leave.
+
+    Args:
+        path (str): The path to the shared SQLite database file.
+        worker_id (str): The unique name of this worker.
+        lease_seconds (float): How long heartbeats and leases stay valid without being renewed.
+    """
+
+    def __init__(self, path, worker_id, lease_seconds):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        # Transactions are opened by hand so each rebalance holds the write lock from its first read
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS workers (worker TEXT PRIMARY KEY, heartbeat REAL NOT NULL)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS leases (tenant TEXT PRIMARY KEY, worker TEXT NOT NULL, expires REAL NOT NULL)")
+
+    def rebalance(self, tenants, busy=()):
+        """
+        Heartbeats, renews this worker's leases and moves it towards its fair share of the tenants.
+        Tenants beyond the share are released and free or expired tenants are taken up to it.
+
+        Args:
+            tenants (list): The names of every tenant.
+            busy (set): Tenants that are syncing and must not be released yet.
+
+        Returns:
+            set: The tenants this worker owns.
+        """
+        now = time.time()
+        expires = now + self.lease_seconds
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            self.db.execute(
+                "INSERT OR REPLACE INTO workers (worker, heartbeat) VALUES (?, ?)", (self.worker_id, now))
+            self.db.execute("DELETE FROM workers WHERE heartbeat < ?", (now - self.lease_seconds,))
+            self.db.execute("DELETE FROM leases WHERE expires < ?", (now,))
+
+            workers = [row[0] for row in self.db.execute("SELECT worker FROM workers ORDER BY worker")]
+            # The first len(tenants) % len(workers) workers take one tenant more than the others
+            share = len(tenants) // len(workers) + (workers.index(self.worker_id) < len(tenants) % len(workers))
+
+            leases = dict(self.db.execute("SELECT tenant, worker FROM leases").fetchall())
+            owned = sorted(tenant for tenant in tenants if leases.get(tenant) == self.worker_id)
+            released = [tenant for tenant in reversed(owned) if tenant not in busy][:max(len(owned) - share, 0)]
+            for tenant in released:
+                self.db.execute("DELETE FROM leases WHERE tenant = ?", (tenant,))
+            owned = [tenant for tenant in owned if tenant not in released]
+            for tenant in [tenant for tenant in tenants if tenant not in leases][:max(share - len(owned), 0)]:
+                self.db.execute(
+                    "INSERT INTO leases (tenant, worker, expires) VALUES (?, ?, ?)", (tenant, self.worker_id, expires))
+                owned.append(tenant)
+            self.db.execute("UPDATE leases SET expires = ? WHERE worker = ?", (expires, self.worker_id))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return set(owned)
+
+    def release_tenant(self, tenant):
+        """
+        Gives up this worker's lease on one tenant.
+
+        Args:
+            tenant (str): The name of the tenant.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM leases WHERE tenant = ? AND worker = ?", (tenant, self.worker_id))
+
+    def release(self):
+        """
+        Gives up every lease of this worker so others can take its tenants straight away.
+        """
+        with self.db:
+            self.db.execute("DELETE FROM leases WHERE worker = ?", (self.worker_id,))
+            self.db.execute("DELETE FROM workers WHERE worker = ?", (self.worker_id,))
+
+
+class Tenant:
+    """
+    One household synced by a multi-tenant worker, with its own Firefly III instance, Plaid items,
+    Plaid client and state database. Its settings are those of the worker's config.toml overridden
+    by its tenant file.
+
+    Args:
+        name (str): The name of the tenant, used for its state database.
+        config (dict): The configuration details of the tenant.
+        accounts (dict): The account details of the tenant.
+    """
+
+    def __init__(self, name, config, accounts):
+        self.name = name
+        self.config = config
+        self.accounts = accounts
+        self.client = plaid_client(config)
+        self.state = StateStore(config['state_path'])
+        self.firefly = FireflyClient(config)
+        self.firefly_ids = FireflyIdIndex(self.state)
+        self.dead_letters = DeadLetterQueue(self.state)
+        self.item_schedule = ItemSchedule(config, self.state) if config.get('adaptive_sync') else None
+        self.refreshed = False
+        self.next_sync = 0
+
+    def due(self):
+        """
+        Returns True if the tenant should be synced now.
+        """
+        return time.time() >= self.next_sync
+
+    def sync(self):
+        """
+        Syncs every item of the tenant, or the due ones under an adaptive schedule.
+        """
+        self.next_sync = time.time() + (60 if self.item_schedule else self.config['sync_minutes'] * 60)
+        if not self.refreshed:
+            firefly_refresh_id_index(self.config, self.firefly, self.accounts, self.firefly_ids, self.state)
+            self.refreshed = True
+        sync(self.config, self.accounts, self.client, self.firefly, self.firefly_ids, self.state,
+             self.dead_letters, item_schedule=self.item_schedule)
+
+    def close(self):
+        """
+        Closes the tenant's state database.
+        """
+        self.state.close()
+
+
+def read_tenant(config, name):
+    """
+    Reads a tenant file from tenants_dir on top of the worker's configuration. Each tenant gets
+    its own state database in tenants_dir unless its file sets state_path. The keys that say whose
+    bank and ledger are synced are never taken from the worker's configuration.
+
+    Args:
+        config (dict): The configuration details of the worker.
+        name (str): The name of the tenant, its file name without .toml.
+
+    Returns:
+        tuple: The configuration details and the account details of the tenant.
+
+    Raises:
+        ValueError: If the tenant file leaves out one of TENANT_KEYS or its accounts.
+    """
+    with open(os.path.join(config['tenants_dir'], f'{name}.toml'), 'r') as file:
+        tenant_file = toml.load(file)
+    missing = [key for key in TENANT_KEYS if not tenant_file.get('config', {}).get(key)]
+    if not tenant_file.get('accounts'):
+        missing.append('[accounts]')
+    if missing:
+        raise ValueError(f"Tenant file {name}.toml must set {', '.join(missing)}")
+    tenant_config = {
+        **config,
+        'state_path': os.path.join(config['tenants_dir'], f'{name}.db'),
+        **tenant_file.get('config', {}),
+    }
+    return tenant_config, tenant_file.get('accounts', {})
+
+
+def start_metrics_server(config):
+    """
+    Serves the Prometheus metrics in the background if metrics_port is set.
+
+    Args:
+        config (dict): The configuration details.
+    """
+    if config.get('metrics_port'):
+        start_http_server(config['metrics_port'], config.get('metrics_address', '0.0.0.0'))
+        logging.info(f"Serving metrics on port {config['metrics_port']}.")
+
+
+def run_tenants(config):
+    """
+    Runs this process as one of possibly many workers sharing the tenants found in tenants_dir.
+    Every lease_seconds / 3 the worker heartbeats and rebalances its tenants, then it syncs its
+    due tenants in the background, up to tenant_max_workers at the same time.
+
+    Args:
+        config (dict): The configuration details of the worker.
+    """
+    tenants_dir = config['tenants_dir']
+    lease_seconds = config.get('lease_seconds', 60)
+    worker_id = config.get('worker_id') or f'{socket.gethostname()}-{os.getpid()}'
+    leases = LeaseTable(config.get('lease_path', os.path.join(tenants_dir, 'leases.db')), worker_id, lease_seconds)
+    logging.info(f"Starting worker {worker_id} for the tenants in {tenants_dir}.")
+    # Metrics of every tenant synced by this worker are served together
+    start_metrics_server(config)
+
+    running = {}
+    syncing = {}
+    # Tenants that failed to start, with the modification time of their file then. They are left
+    # out of the rebalance, so they don't hold a lease or a share, until their file changes.
+    failed = {}
+    next_rebalance = 0
+    executor = ThreadPoolExecutor(max_workers=config.get('tenant_max_workers', 4))
+    try:
+        while True:
+            for name in [name for name, future in syncing.items() if future.done()]:
+                try:
+                    syncing.pop(name).result()
+                except Exception as e:
+                    logging.error(f"Failed to sync tenant {name}: {e}")
+
+            if time.time() >= next_rebalance:
+                next_rebalance = time.time() + lease_seconds / 3
+                files = {
+                    file[:-len('.toml')]: os.path.getmtime(os.path.join(tenants_dir, file))
+                    for file in os.listdir(tenants_dir) if file.endswith('.toml')
+                }
+                names = sorted(name for name, modified in files.items() if failed.get(name) != modified)
+                owned = leases.rebalance(names, set(syncing))
+                # A tenant whose lease expired during a long sync is closed once the sync finishes
+                for name in [name for name in running if name not in owned and name not in syncing]:
+                    logging.info(f"Handing over tenant {name}.")
+                    running.pop(name).close()
+                for name in sorted(owned - set(running)):
+                    try:
+                        tenant_config, accounts = read_tenant(config, name)
+                        running[name] = Tenant(name, tenant_config, accounts)
+                        logging.info(f"Took over tenant {name}.")
+                    except Exception as e:
+                        logging.error(f"Failed to start tenant {name}. It is retried once its file changes: {e}")
+                        leases.release_tenant(name)
+                        owned.discard(name)
+                        failed[name] = files[name]
+
+            for name, tenant in running.items():
+                if name in owned and name not in syncing and tenant.due():
+                    syncing[name] = executor.submit(tenant.sync)
+            time.sleep(1)
+    finally:
+        executor.shutdown(wait=True)
+        for tenant in running.values():
+            tenant.close()
+        leases.release()
+
+
+def month_shards(start, end):
+    """
+    Splits a date range into calendar months.
+
+    Args:
+        start (datetime.date): The first date of the range.
+        end (datetime.date): The last date of the range.
+
+    Returns:
+        list: The (first, last) dates of each month, clipped to the range.
+    """
+    shards = []
+    first = start
+    while first <= end:
+        next_month = (first.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+        shards.append((first, min(next_month - datetime.timedelta(days=1), end)))
+        first = next_month
+    return shards
+
+
+def plaid_get_transactions(client, token, account_id, start, end):
+    """
+    Fetches every transaction of one Plaid account in a date range through /transactions/get.
+
+    Args:
+        client (PlaidClient): The Plaid client.
+        token (str): The Plaid access token of the item.
+        account_id (str): The Plaid account ID.
+        start (datetime.date): The first date of the range.
+        end (datetime.date): The last date of the range.
+
+    Returns:
+        list: The transactions from Plaid, in the order Plaid returned them.
+    """
+    transactions = []
+    while True:
+        request = client.make_request(
+            'transactions_get', access_token=token, start_date=start, end_date=end,
+            options={'account_ids': [account_id], 'count': 500, 'offset': len(transactions)})
+        with STAGE_LATENCY.labels('plaid_get').time():
+            response = client.transactions_get(request)
+        transactions += response['transactions']
+        if not response['transactions'] or len(transactions) >= response['total_transactions']:
+            return transactions
+
+
+def shard_key(token, account_id, start, end):
+    """
+    Builds the checkpoint key of a backfill shard. It holds the shard's own dates rather than its
+    month, as the first and last shards are clipped to the range of the backfill that made them.
+
+    Args:
+        token (str): The Plaid access token of the item.
+        account_id (str): The Plaid account ID.
+        start (datetime.date): The first date of the shard.
+        end (datetime.date): The last date of the shard.
+
+    Returns:
+        str: The key of the shard.
+    """
+    return f"{item_key(token)}:{account_id}:{start}:{end}"
+
+
+def backfill_shard(config, accounts, client, firefly, firefly_ids, state, dead_letters, token, account_id, start, end):
+    """
+    Imports the history of one Plaid account for one month, and checkpoints it once it is written.
+    Shards reaching today are not checkpointed, as transactions can still be added to them.
+
+    Args:
+        config (dict): The configuration details.
+        accounts (dict): The account details.
+        client (PlaidClient): The Plaid client.
+        firefly (FireflyClient): The Firefly III client.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        state (StateStore): The persistent importer state.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay.
+        token (str): The Plaid access token of the item.
+        account_id (str): The Plaid account ID.
+        start (datetime.date): The first date of the shard.
+        end (datetime.date): The last date of the shard.
+
+    Returns:
+        int: The number of transactions in the shard, or None if not all of them were written.
+    """
+    transactions = plaid_get_transactions(client, token, account_id, start, end)
+    if not insert_transactions(config, firefly, accounts, transactions, firefly_ids, dead_letters):
+        return None
+    if end < datetime.date.today():
+        state.complete_shard(shard_key(token, account_id, start, end), len(transactions))
+    return len(transactions)
+
+
+def backfill(config, accounts, client, firefly, firefly_ids, state, dead_letters, start=None, end=None):
+    """
+    Imports the history of every mapped account, split into one shard per account and month.
+    Shards are imported in parallel, up to backfill_workers at once, and each is checkpointed once
+    written, so a backfill that stopped resumes with the shards it had not finished. Duplicates are
+    only grouped within an account and day, so shards group them as a sync of the same history does.
+    A shard only counts as done for the exact dates it covered, so a later backfill reaching further
+    into a month imports the rest of it.
+
+    Args:
+        config (dict): The configuration details.
+        accounts (dict): The account details.
+        client (PlaidClient): The Plaid client.
+        firefly (FireflyClient): The Firefly III client.
+        firefly_ids (FireflyIdIndex): The existing external transaction ids from Firefly III.
+        state (StateStore): The persistent importer state.
+        dead_letters (DeadLetterQueue): Where failed inserts are kept for replay.
+        start (datetime.date): The first date to import, two years ago by default.
+        end (datetime.date): The last date to import, today by default.
+
+    Returns:
+        boolean: True if every shard was written.
+    """
+    end = end or datetime.date.today()
+    start = start or (end - datetime.timedelta(days=730)).replace(day=1)
+    completed = state.completed_shards()
+
+    shards = []
+    for token in config['plaid_access_tokens']:
+        response = client.accounts_get(client.make_request('accounts_get', access_token=token))
+        for account in response['accounts']:
+            if account['account_id'] not in accounts:
+                continue
+            for first, last in month_shards(start, end):
+                if shard_key(token, account['account_id'], first, last) not in completed:
+                    shards.append((token, account['account_id'], first, last))
+
+    workers = config.get('backfill_workers', config.get('plaid_max_workers', 4))
+    shard_config = share_writers(config, workers)
+
+    logging.info(f"Backfilling {len(shards)} shards from {start} to {end}.")
+    started = time.monotonic()
+    imported = failed = done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(backfill_shard, shard_config, accounts, client, firefly, firefly_ids, state, dead_letters,
+                            *shard): shard
+            for shard in shards
+        }
+        for future in as_completed(futures):
+            token, account_id, first, _ = futures[future]
+            done += 1
+            try:
+                count = future.result()
+            except Exception as e:
+                logging.error(f"Failed to backfill account {account_id} for {first:%Y-%m}: {e}")
+                count = None
+            if count is None:
+                failed += 1
+            else:
+                imported += count
+            logging.info(f"Backfilled {done} of {len(shards)} shards, {imported} transactions "
+                         f"in {time.monotonic() - started:.0f}s.")
+
+    if failed:
+        logging.warning(f"{failed} shards failed. Run the backfill again to retry them.")
+    return not failed
+
+
+class PageCache:
+    """
+    Wraps the Plaid client to keep /transactions/sync pages on disk, keyed by item and cursor,
+    so that repeated plans of the same history don't fetch it from Plaid again. The last page of an
+    item can miss transactions Plaid received since it was cached; delete the directory to refresh.
+
+    Args:
+        client (PlaidClient): The Plaid client.
+        directory (str): Where the pages are kept.
+    """
+
+    def __init__(self, client, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.client = client
+        self.directory = directory
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def transactions_sync(self, request):
+        request_data = request if isinstance(request, dict) else request.to_dict()
+        key = hashlib.sha256(f"{request_data['access_token']}:{request_data.get('cursor', '')}".encode()).hexdigest()
+        path = os.path.join(self.directory, f'{key}.json')
+        if os.path.exists(path):
+            with open(path, 'r') as file:
+                return json.load(file)
+
+        response = self.client.transactions_sync(request)
+        page = {kind: response[kind] for kind in ('added', 'modified', 'removed', 'next_cursor', 'has_more')}
+        for kind in ('added', 'modified', 'removed'):
+            page[kind] = [item.to_dict() if hasattr(item, 'to_dict') else item for item in page[kind]]
+        with open(path + '.tmp', 'w') as file:
+            json.dump(page, file, default=str)
+        os.replace(path + '.tmp', path)
+        return response
+
+
+def plan(config, accounts, client, output, cache_dir=None):
+    """
+    Runs a whole sync without writing anything. Plaid is read from the committed cursors, through
+    a page cache if given, and Firefly is only read. Each insert, update, ID merge, removal and delete
+    the sync would make is written to output as a line of JSON. Cursors, the ID index and the dead-letter
+    queue are only updated in an in-memory copy of the state database.
+
+    Args:
+        config (dict): The configuration details.
+        accounts (dict): The account details.
+        client (PlaidClient): The Plaid client.
+        output (file): Where the planned writes go.
+        cache_dir (str): Where to keep Plaid pages between plans, if anywhere.
+    """
+    start = time.perf_counter()
+    state = StateStore.snapshot(config.get('state_path', 'state.db'))
+    firefly = PlanRecorder(config, output)
+    firefly_ids = FireflyIdIndex(state)
+    dead_letters = DeadLetterQueue(state)
+    if cache_dir:
+        client = PageCache(client, cache_dir)
+
+    firefly_refresh_id_index(config, firefly, accounts, firefly_ids, state)
+    refreshed = time.perf_counter()
+    sync(config, accounts, client, firefly, firefly_ids, state, dead_letters)
+    output.flush()
+    elapsed = time.perf_counter() - start
+
+    stages = {
+        sample.labels['stage']: sample.value
+        for metric in STAGE_LATENCY.collect() for sample in metric.samples if sample.name.endswith('_sum')
+    }
+    logging.info(
+        f"Planned {firefly.planned} writes in {elapsed:.2f}s (ID index refresh {refreshed - start:.2f}s): "
+        + ", ".join(f"{count} {action}" for action, count in sorted(firefly.counts.items())))
+    logging.info("Time per stage: " + ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in sorted(stages.items())))
+
+
+def manage_dead_letters(config, action, ids=None):
+    """
+    Lists, replays or purges the transactions kept in the dead-letter queue.
+
+    Args:
+        config (dict): The configuration details.
+        action (str): One of list, replay or purge.
+        ids (list): Only act on these entries. Acts on every entry if empty.
+    """
+    state = StateStore(config.get('state_path', 'state.db'))
+    dead_letters = DeadLetterQueue(state)
+
+    if action == 'list':
+        for entry_id, payload, error, attempts, created in dead_letters.items(ids=ids):
+            transaction = payload['transactions'][0]
+            print(f"{entry_id}\t{created}\t{transaction['date']}\t{transaction['amount']}\t"
+                  f"{transaction['description']}\t{transaction['external_id']}\t{attempts} attempts\t{error}")
+        print(f"{len(dead_letters)} transactions in the dead-letter queue.")
+    elif action == 'replay':
+        replayed, failed = replay_dead_letters(
+            FireflyClient(config), dead_letters, FireflyIdIndex(state), ids=ids)
+        print(f"Replayed {replayed} transactions, {failed} failed again.")
+    elif action == 'purge':
+        dead_letters.remove(ids or None)
+        print(f"{len(dead_letters)} transactions left in the dead-letter queue.")
 
 
 def main():
     """
     The main function of the script. It reads the configuration, syncs transactions from Plaid,
     gets existing transactions from Firefly III, and creates new transactions in Firefly III.
+    Without a command it syncs on a schedule, like the sync command.
     """
+    parser = argparse.ArgumentParser(description="Import transactions from Plaid to Firefly III.")
+    parser.add_argument('--config', default='config.toml', help="Path to the configuration file.")
+    commands = parser.add_subparsers(dest='command')
+    sync_parser = commands.add_parser('sync', help="Sync transactions on a schedule.")
+    sync_parser.add_argument(
+        '--once', action='store_true', help="Sync once and exit, for cron jobs and one-shot containers.")
+    commands.add_parser('accounts', help="List the Plaid accounts of every access token.")
+    dead_letters_parser = commands.add_parser(
+        'dead-letters', help="Inspect, replay or purge the Firefly inserts that failed.")
+    dead_letters_parser.add_argument('action', choices=['list', 'replay', 'purge'])
+    dead_letters_parser.add_argument('ids', nargs='*', type=int, help="Only act on these entries.")
+    plan_parser = commands.add_parser(
+        'plan', help="Show the writes a sync would make to Firefly, without making them.")
+    plan_parser.add_argument('--output', default='-', help="Where to write the planned writes as JSONL.")
+    plan_parser.add_argument('--cache', help="Keep the Plaid pages in this directory for the next plan.")
+    backfill_parser = commands.add_parser(
+        'backfill', help="Import the transaction history by account and month, resuming where it stopped.")
+    backfill_parser.add_argument('--start', type=datetime.date.fromisoformat, help="First date, YYYY-MM-DD.")
+    backfill_parser.add_argument('--end', type=datetime.date.fromisoformat, help="Last date, YYYY-MM-DD.")
+    args = parser.parse_args()
+
     logging.basicConfig()
     logging.root.setLevel(logging.INFO)
-
-    global cursors
+    # Commands that run once exit with an error when they can't, so cron and job runners see it
+    once = args.command in ('plan', 'backfill') or (args.command == 'sync' and args.once)
 
     try:
-        config, accounts = read_config('config.toml')
+        config, accounts = read_config(args.config)
     except Exception as e:
         logging.error("Failed to read config file: %s", e)
+        if once:
+            sys.exit(1)
         return
 
-    logging.info("Connecting to Plaid.")
-    try:
-        configuration = plaid.Configuration(
-            host=plaid.Environment.Development,
-            api_key={
-                'clientId': config['plaid_client_id'],
-                'secret': config['plaid_secret'],
-            }
-        )
-        api_client = plaid.ApiClient(configuration)
-        client = plaid_api.PlaidApi(api_client)
-    except Exception as e:
-        logging.error("Failed to connect to Plaid: %s", e)
+    # A multi-tenant worker only syncs on a schedule, as the other commands act on a single household
+    if config.get('tenants_dir') and (once or args.command == 'dead-letters'):
+        command = 'sync --once' if args.command == 'sync' else args.command
+        logging.error(f"The {command} command is not supported with tenants_dir. Run it with the config file of a single household.")
+        sys.exit(1)
+
+    if args.command == 'dead-letters':
+        manage_dead_letters(config, args.action, args.ids)
+        return
+
+    client = plaid_client(config)
+
+    if args.command == 'accounts':
+        display_plaid_accounts(config, client)
+        return
+
+    if config.get('tenants_dir'):
+        run_tenants(config)
         return
 
     if not accounts:
         logging.warning(
-            "No accounts found in config.toml. Displaying available accounts below:")
+            f"No accounts found in {args.config}. Displaying available accounts below:")
         display_plaid_accounts(config, client)
+        if once:
+            sys.exit(1)
         return
 
-    cursors = [None] * len(config['plaid_access_tokens'])
+    if args.command == 'plan':
+        output = sys.stdout if args.output == '-' else open(args.output, 'w')
+        try:
+            plan(config, accounts, client, output, args.cache)
+        finally:
+            if output is not sys.stdout:
+                output.close()
+        return
+
+    try:
+        state = StateStore(config.get('state_path', 'state.db'))
+    except Exception as e:
+        logging.error("Failed to open state database: %s", e)
+        if once:
+            sys.exit(1)
+        return
 
     logging.info("Getting transactions external_ids from Firefly.")
+    firefly = FireflyClient(config)
+    firefly_ids = FireflyIdIndex(state)
+    dead_letters = DeadLetterQueue(state)
     try:
-        firefly_ids = firefly_filter_for_transaction_ids(
-            firefly_get_transactions(config, accounts))
+        firefly_refresh_id_index(config, firefly, accounts, firefly_ids, state)
     except Exception as e:
         # Can't seem to get hostname to resolve so I'm using IP. Not sure if that is my own issue
         logging.error("Failed to get transactions from Firefly: %s", e)
+        if once:
+            sys.exit(1)
         return
 
-    logging.info(f"Starting importer. Importing every {config['sync_minutes']} minutes")
+    if args.command == 'backfill':
+        if not backfill(config, accounts, client, firefly, firefly_ids, state, dead_letters, args.start, args.end):
+            sys.exit(1)
+        return
 
-    # sync(config, accounts, client, firefly_ids)
+    if args.command == 'sync' and args.once:
+        if not sync(config, accounts, client, firefly, firefly_ids, state, dead_letters):
+            sys.exit(1)
+        return
 
-    schedule.every(config['sync_minutes']).minutes.do(
+    start_metrics_server(config)
+
+    triggers = None
+    sync_minutes = config['sync_minutes']
+    if config.get('webhook_port'):
+        try:
+            item_tokens = plaid_item_ids(client, config, state)
+            if config.get('plaid_webhook_url'):
+                for token in config['plaid_access_tokens']:
+                    client.item_webhook_update(client.make_request(
+                        'item_webhook_update', access_token=token, webhook=config['plaid_webhook_url']))
+        except Exception as e:
+            logging.error("Failed to set up Plaid webhooks: %s", e)
+            return
+        triggers = WebhookTriggers(config.get('webhook_debounce_seconds', 10))
+        start_webhook_server(config, item_tokens, triggers)
+        sync_minutes = config.get('fallback_sync_minutes', 360)
+        logging.info(f"Listening for Plaid webhooks on port {config['webhook_port']}.")
+
+    item_schedule = None
+    if config.get('adaptive_sync'):
+        # Check every minute for items whose own interval has passed
+        item_schedule = ItemSchedule(config, state)
+        sync_minutes = 1
+        logging.info(
+            f"Starting importer. Polling each item every {item_schedule.min_seconds / 60:.0f} "
+            f"to {item_schedule.max_seconds / 60:.0f} minutes depending on its activity")
+    else:
+        logging.info(f"Starting importer. Importing every {sync_minutes} minutes")
+
+    # sync(config, accounts, client, firefly, firefly_ids, state, dead_letters)
+
+    schedule.every(sync_minutes).minutes.do(
         sync,
         config=config,
         accounts=accounts,
         client=client,
-        firefly_ids=firefly_ids
+        firefly=firefly,
+        firefly_ids=firefly_ids,
+        state=state,
+        dead_letters=dead_letters,
+        item_schedule=item_schedule
     )
 
     while True:
         schedule.run_pending()
-        time.sleep(1)
+        if not triggers:
+            time.sleep(1)
+            continue
+        # Sleep until the next scheduled sync unless a webhook arrives first
+        tokens = triggers.wait(max(schedule.idle_seconds() or 0, 1))
+        if tokens:
+            sync(config, accounts, client, firefly, firefly_ids, state, dead_letters, tokens, item_schedule)
 
 
 if __name__ == "__main__":